@@ -0,0 +1,273 @@
+import threading
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Колоночное хранилище истории отчетов для быстрых агрегатов без запросов к БД
+
+INITIAL_CAPACITY = 1024
+
+
+def _to_day(value: date) -> int:
+    return int(np.datetime64(value, 'D').astype(np.int64))
+
+
+def _from_day(day: int) -> date:
+    return date(1970, 1, 1) + timedelta(days=int(day))
+
+
+class ReportStore:
+    """Отчеты в виде массивов NumPy: report_id, user_id, work_type, day, amount."""
+
+    def __init__(self, work_types: List[str]):
+        self._lock = threading.Lock()
+        self.work_types: List[str] = list(work_types)
+        self._work_type_ids: Dict[str, int] = {name: i for i, name in enumerate(self.work_types)}
+        self._size = 0
+        self._loaded = False
+        self._loading = False
+        self._deferred: List[tuple] = []
+        self._loaded_max_id = 0
+        # Увеличивается при каждом изменении данных, используется как ключ кэшей
+        self.version = 0
+        self._allocate(INITIAL_CAPACITY)
+
+    def _allocate(self, capacity: int):
+        self.report_id = np.zeros(capacity, dtype=np.int64)
+        self.user_id = np.zeros(capacity, dtype=np.int64)
+        self.work_type = np.zeros(capacity, dtype=np.int16)
+        self.day = np.zeros(capacity, dtype=np.int32)
+        self.amount = np.zeros(capacity, dtype=np.int32)
+
+    def _grow(self, needed: int):
+        capacity = len(self.report_id)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ('report_id', 'user_id', 'work_type', 'day', 'amount'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _work_type_id(self, work_type: str) -> int:
+        type_id = self._work_type_ids.get(work_type)
+        if type_id is None:
+            type_id = len(self.work_types)
+            self.work_types.append(work_type)
+            self._work_type_ids[work_type] = type_id
+        return type_id
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self, conn, tenant_id: Optional[int] = None):
+        """Загружает историю из таблицы reports: всю или только одного цеха.
+
+        Изменения, пришедшие во время выборки, откладываются и применяются поверх нее.
+        """
+        with self._lock:
+            self._loading = True
+            self._deferred = []
+        try:
+            with conn.cursor() as cursor:
+                if tenant_id is None:
+                    cursor.execute(
+                        "SELECT report_id, user_id, work_type, report_date, amount FROM reports ORDER BY report_id"
+                    )
+                else:
+                    cursor.execute(
+                        "SELECT report_id, user_id, work_type, report_date, amount FROM reports "
+                        "WHERE tenant_id = %s ORDER BY report_id",
+                        (tenant_id,)
+                    )
+                rows = cursor.fetchall()
+        except Exception:
+            with self._lock:
+                self._loading = False
+                self._deferred = []
+            raise
+
+        with self._lock:
+            self._size = 0
+            self._allocate(max(INITIAL_CAPACITY, len(rows)))
+            if rows:
+                report_ids, user_ids, work_types, dates, amounts = zip(*rows)
+                n = len(rows)
+                self.report_id[:n] = report_ids
+                self.user_id[:n] = user_ids
+                self.work_type[:n] = [self._work_type_id(w) for w in work_types]
+                self.day[:n] = np.array(dates, dtype='datetime64[D]').astype(np.int32)
+                self.amount[:n] = amounts
+                self._size = n
+                self._loaded_max_id = int(self.report_id[:n].max())
+            for method, args in self._deferred:
+                method(*args)
+            self._deferred = []
+            self._loading = False
+            self._loaded = True
+            self.version += 1
+
+    def _defer(self, method, *args) -> bool:
+        # Вызывается под блокировкой: до загрузки изменения не нужны, во время загрузки откладываются
+        if self._loaded:
+            return False
+        if self._loading:
+            self._deferred.append((method, args))
+        return True
+
+    def append(self, report_id: int, user_id: int, work_type: str, report_date: date, amount: int):
+        """Добавляет новый отчет. До начала первой загрузки ничего не делает."""
+        with self._lock:
+            if not self._defer(self._append, report_id, user_id, work_type, report_date, amount):
+                self._append(report_id, user_id, work_type, report_date, amount)
+
+    def _append(self, report_id: int, user_id: int, work_type: str, report_date: date, amount: int):
+        # Отчет мог попасть в выборку load(), если был закоммичен до нее
+        if report_id <= self._loaded_max_id and (self.report_id[:self._size] == report_id).any():
+            return
+        self._grow(self._size + 1)
+        i = self._size
+        self.report_id[i] = report_id
+        self.user_id[i] = user_id
+        self.work_type[i] = self._work_type_id(work_type)
+        self.day[i] = _to_day(report_date)
+        self.amount[i] = amount
+        self._size += 1
+        self.version += 1
+
+    def _find(self, report_id: int) -> Optional[int]:
+        found = np.flatnonzero(self.report_id[:self._size] == report_id)
+        return int(found[0]) if len(found) else None
+
+    def update_amount(self, report_id: int, amount: int):
+        with self._lock:
+            if not self._defer(self._update_amount, report_id, amount):
+                self._update_amount(report_id, amount)
+
+    def _update_amount(self, report_id: int, amount: int):
+        i = self._find(report_id)
+        if i is not None:
+            self.amount[i] = amount
+            self.version += 1
+
+    def remove(self, report_id: int):
+        with self._lock:
+            if not self._defer(self._remove, report_id):
+                self._remove(report_id)
+
+    def _remove(self, report_id: int):
+        i = self._find(report_id)
+        if i is None:
+            return
+        # Порядок строк для агрегатов не важен: переносим последнюю строку на место удаленной
+        last = self._size - 1
+        for name in ('report_id', 'user_id', 'work_type', 'day', 'amount'):
+            column = getattr(self, name)
+            column[i] = column[last]
+        self._size -= 1
+        self.version += 1
+
+    def _window(self, start: date, end: date) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        n = self._size
+        days = self.day[:n]
+        mask = (days >= _to_day(start)) & (days < _to_day(end))
+        return self.user_id[:n][mask], self.work_type[:n][mask], self.amount[:n][mask]
+
+    def totals(self, start: date, end: date, user_id: Optional[int] = None) -> Dict[Tuple[int, str], int]:
+        """Сумма amount по (user_id, work_type) за полуинтервал [start, end)."""
+        with self._lock:
+            users, types, amounts = self._window(start, end)
+            if user_id is not None:
+                mask = users == user_id
+                users, types, amounts = users[mask], types[mask], amounts[mask]
+            if not len(users):
+                return {}
+            unique_users, user_idx = np.unique(users, return_inverse=True)
+            n_types = len(self.work_types)
+            sums = np.bincount(
+                user_idx * n_types + types,
+                weights=amounts,
+                minlength=len(unique_users) * n_types
+            ).astype(np.int64)
+            work_types = list(self.work_types)
+
+        result = {}
+        for key in np.flatnonzero(sums):
+            u, t = divmod(int(key), n_types)
+            result[(int(unique_users[u]), work_types[t])] = int(sums[key])
+        return result
+
+    def totals_by_work_type(self, start: date, end: date) -> Dict[str, int]:
+        """Сумма amount по видам работ за полуинтервал [start, end)."""
+        with self._lock:
+            _, types, amounts = self._window(start, end)
+            sums = np.bincount(types, weights=amounts, minlength=len(self.work_types)).astype(np.int64)
+            work_types = list(self.work_types)
+        return {work_types[t]: int(sums[t]) for t in np.flatnonzero(sums)}
+
+    def daily_totals(self, start: date, end: date, work_type: Optional[str] = None,
+                     user_id: Optional[int] = None) -> List[Tuple[date, int]]:
+        """Сумма amount по дням за полуинтервал [start, end), включая дни без отчетов."""
+        first, last = _to_day(start), _to_day(end)
+        with self._lock:
+            n = self._size
+            days = self.day[:n]
+            mask = (days >= first) & (days < last)
+            if work_type is not None:
+                type_id = self._work_type_ids.get(work_type)
+                if type_id is None:
+                    mask[:] = False
+                else:
+                    mask &= self.work_type[:n] == type_id
+            if user_id is not None:
+                mask &= self.user_id[:n] == user_id
+            sums = np.bincount(
+                days[mask] - first,
+                weights=self.amount[:n][mask],
+                minlength=max(last - first, 0)
+            ).astype(np.int64)
+        return [(_from_day(first + i), int(total)) for i, total in enumerate(sums)]
+
+    def daily_series(self, start: date, end: date, by: str = 'work_type',
+                     limit: Optional[int] = None) -> Tuple[List[date], Dict[object, List[int]]]:
+        """Суммы по дням за [start, end) в разрезе work_type или user_id, самые большие ряды первыми."""
+        first, last = _to_day(start), _to_day(end)
+        n_days = max(last - first, 0)
+        with self._lock:
+            n = self._size
+            days = self.day[:n]
+            mask = (days >= first) & (days < last)
+            keys = (self.work_type if by == 'work_type' else self.user_id)[:n][mask]
+            unique_keys, key_idx = np.unique(keys, return_inverse=True)
+            sums = np.bincount(
+                key_idx * n_days + (days[mask] - first),
+                weights=self.amount[:n][mask],
+                minlength=len(unique_keys) * n_days
+            ).astype(np.int64).reshape(len(unique_keys), n_days)
+            work_types = list(self.work_types)
+
+        order = np.argsort(-sums.sum(axis=1), kind='stable')
+        if limit is not None:
+            order = order[:limit]
+        series = {}
+        for i in order:
+            key = work_types[unique_keys[i]] if by == 'work_type' else int(unique_keys[i])
+            series[key] = sums[i].tolist()
+        return [_from_day(first + i) for i in range(n_days)], series
+
+    def compare_periods(self, today: date, days: int,
+                        user_id: Optional[int] = None) -> Dict[Tuple[int, str], Tuple[int, int]]:
+        """Текущий период из `days` дней по today включительно против предыдущего такого же."""
+        end = today + timedelta(days=1)
+        start = end - timedelta(days=days)
+        previous_start = start - timedelta(days=days)
+        current = self.totals(start, end, user_id)
+        previous = self.totals(previous_start, start, user_id)
+        return {key: (current.get(key, 0), previous.get(key, 0)) for key in set(current) | set(previous)}
@@ -0,0 +1,57 @@
+"""Сравнение ReportStore с эквивалентными SQL-запросами к таблице reports.
+
+Запуск: python bench_analytics.py [повторы]
+Использует те же переменные окружения для БД, что и bot.py.
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bot import WORK_TYPES, get_db_connection
+from analytics import ReportStore
+
+TOTALS_SQL = """
+    SELECT user_id, work_type, SUM(amount)
+    FROM reports
+    WHERE report_date >= %s AND report_date < %s
+    GROUP BY user_id, work_type
+"""
+
+
+def timed(func, repeats: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    today = datetime.now().date()
+    end = today + timedelta(days=1)
+
+    with get_db_connection() as conn:
+        store = ReportStore(WORK_TYPES)
+        started = time.perf_counter()
+        store.load(conn)
+        print(f"load: {len(store)} reports in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        for days in (7, 30, 365):
+            start = end - timedelta(days=days)
+
+            def run_sql():
+                with conn.cursor() as cursor:
+                    cursor.execute(TOTALS_SQL, (start, end))
+                    return {(u, w): int(total) for u, w, total in cursor.fetchall()}
+
+            sql_result = run_sql()
+            store_result = store.totals(start, end)
+            assert sql_result == store_result, f"results differ for {days} days"
+
+            sql_ms = timed(run_sql, repeats)
+            store_ms = timed(lambda: store.totals(start, end), repeats)
+            print(f"{days:>4} days: sql {sql_ms:8.2f} ms  store {store_ms:8.2f} ms  x{sql_ms / store_ms:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Стоимость маршрутизации callback-запроса: последовательные CallbackQueryHandler с regex
+против одного CallbackRouter.
+
+Запуск: python bench_callbacks.py [количество действий] [повторы]
+"""
+import sys
+import time
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import CallbackQueryHandler
+
+from callbacks import CallbackRouter, encode_callback
+
+
+def noop(update, context):
+    return None
+
+
+def make_update(update_id: int, data: str) -> Update:
+    user = User(id=1, first_name='bench', is_bot=False)
+    query = CallbackQuery(id=str(update_id), from_user=user, chat_instance='bench', data=data)
+    return Update(update_id, callback_query=query)
+
+
+def route_sequential(handlers, update):
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+    return None
+
+
+def main():
+    n_actions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    actions = [f'action{i}' for i in range(n_actions)]
+    # Старый формат: "<действие>_<аргумент>" и отдельный regex на каждое действие
+    regex_handlers = [CallbackQueryHandler(noop, pattern=f'^{a}_[0-9]+$') for a in actions]
+    router = CallbackRouter({f'a{i}': noop for i in range(n_actions)})
+
+    legacy_updates = [make_update(i, f'{actions[i % n_actions]}_{i}') for i in range(n_actions)]
+    routed_updates = [make_update(i, encode_callback(f'a{i % n_actions}', i)) for i in range(n_actions)]
+
+    for name, func, updates in (
+        ('regex handlers', lambda u: route_sequential(regex_handlers, u), legacy_updates),
+        ('router', router.check_update, routed_updates),
+    ):
+        started = time.perf_counter()
+        for i in range(repeats):
+            update = updates[i % len(updates)]
+            assert func(update)
+            # Аргументы разбираются в обработчике в обоих вариантах
+            if name == 'regex handlers':
+                int(update.callback_query.data.split('_')[1])
+        elapsed = time.perf_counter() - started
+        print(f"{name:>15}: {elapsed / repeats * 1e6:7.2f} us/update ({n_actions} actions)")
+
+
+if __name__ == '__main__':
+    main()
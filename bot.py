@@ -1,20 +1,37 @@
+import json
 import logging
+import signal
+import threading
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 import os
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
+from telegram.utils.request import Request
+from analytics import ReportStore
+from charts import shutdown_executor, submit_chart
+from callbacks import CallbackRouter, encode_callback as cb
+from circuit import CircuitBreaker, CircuitOpenError
+from recording import UpdateRecorder
+from scheduling import FairUpdateQueue
 from telegram.ext import (
     Updater,
+    Dispatcher,
+    JobQueue,
+    ExtBot,
     CommandHandler,
-    CallbackQueryHandler,
     MessageHandler,
     Filters,
     CallbackContext,
     ConversationHandler,
+    TypeHandler,
+    PicklePersistence,
+    DispatcherHandlerStop,
 )
 
 # Настройка логгирования
@@ -36,10 +53,11 @@ logger = logging.getLogger(__name__)
     REPORT_AMOUNT,
     MANAGE_USERS,
     ADD_USER,
-    REMOVE_USER
-) = range(11)
+    REMOVE_USER,
+    EDIT_REPORT_AMOUNT
+) = range(12)
 
-# Виды работ
+# Виды работ, с которыми создается каталог нового цеха
 WORK_TYPES = [
     "Распил доски", "Фугование", "Рейсмусование", "Распил на детали",
     "Отверстия в пласть", "Присадка отверстий", "Фрезеровка пазов",
@@ -49,34 +67,188 @@ WORK_TYPES = [
     "Фрезеровка пазов ручек", "Распил на ручки"
 ]
 
+# Действия в callback_data
+CB_MAIN_MENU = 'mm'
+CB_ADMIN_PANEL = 'ap'
+CB_VIEW_TASKS = 'vt'
+CB_VIEW_REPORTS = 'vr'
+CB_SEND_REPORT = 'sr'
+CB_SET_TASK = 'st'
+CB_ADD_WORK_TYPE = 'wt'
+CB_ADD_WORK = 'aw'
+CB_FINISH_ADDING_WORKS = 'fw'
+CB_CONFIRM_TASK = 'ct'
+CB_REPORT_WORK = 'rw'
+CB_REPORT_TASK = 'rt'
+CB_REPORT_WITHOUT_TASK = 'rn'
+CB_MANAGE_USERS = 'mu'
+CB_ADD_USER = 'au'
+CB_REMOVE_USER = 'ru'
+CB_MY_REPORTS = 'my'
+CB_EDIT_LAST_REPORT = 'el'
+CB_DELETE_LAST_REPORT = 'dl'
+# Кнопки видов работ старого формата несут индекс в WORK_TYPES, а не work_type_id
+CB_LEGACY_ADD_WORK = 'law'
+CB_LEGACY_REPORT_WORK = 'lrw'
+
+# Формат callback_data до версии 1, для кнопок в уже отправленных сообщениях
+LEGACY_CALLBACKS = {
+    'main_menu': CB_MAIN_MENU,
+    'admin_panel': CB_ADMIN_PANEL,
+    'view_tasks': CB_VIEW_TASKS,
+    'view_reports': CB_VIEW_REPORTS,
+    'send_report': CB_SEND_REPORT,
+    'set_task': CB_SET_TASK,
+    'add_work_type': CB_ADD_WORK_TYPE,
+    'add_work': CB_LEGACY_ADD_WORK,
+    'finish_adding_works': CB_FINISH_ADDING_WORKS,
+    'confirm_task': CB_CONFIRM_TASK,
+    'report_work': CB_LEGACY_REPORT_WORK,
+    'report_task': CB_REPORT_TASK,
+    'report_without_task': CB_REPORT_WITHOUT_TASK,
+    'manage_users': CB_MANAGE_USERS,
+    'add_user': CB_ADD_USER,
+    'remove_user': CB_REMOVE_USER,
+}
+
+# Цеха (tenants): каждая строка в таблицах ниже принадлежит одному цеху
+DEFAULT_TENANT_ID = 1
+DEFAULT_TENANT_NAME = "Основной цех"
+TENANT_TABLES = ('users', 'tasks', 'task_works', 'reports', 'allowed_users')
+SUPERADMIN_ID = os.getenv('ADMIN_ID')
+# Ключ bot_data, в котором между перезапусками хранится цех пользователей
+USER_TENANTS_KEY = 'user_tenants'
+
+class TenantUnknownError(Exception):
+    """Цех пользователя не удалось определить: действие отклоняется, чужие данные не подставляются."""
+
+SEED_WORK_TYPES_SQL = """
+    INSERT INTO work_types (tenant_id, name, position)
+    SELECT %(tenant_id)s, name, position
+    FROM unnest(%(names)s::TEXT[]) WITH ORDINALITY AS t(name, position)
+"""
+
+# Колоночные кэши истории отчетов для аналитики, по одному на цех
+report_stores: Dict[int, ReportStore] = {}
+_report_store_load_lock = threading.Lock()
+
+ACTIVITY_PERIODS = {'week': 7, 'month': 30}
+CHART_MAX_DAYS = 180
+CHART_MAX_SERIES = 8
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '3'))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+
+# Ошибки, при которых считаем БД недоступной и переходим в деградированный режим
+DB_UNAVAILABLE_ERRORS = (CircuitOpenError, psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+db_breaker = CircuitBreaker('database', failure_threshold=3, reset_timeout=15.0)
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def _create_db_pool() -> ThreadedConnectionPool:
+    options = dict(
+        sslmode=DB_SSLMODE,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
+    )
+    db_url = os.getenv('DATABASE_URL')
+    if db_url:
+        return ThreadedConnectionPool(1, DB_POOL_SIZE, db_url, **options)
+
+    return ThreadedConnectionPool(
+        1, DB_POOL_SIZE,
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        dbname=os.getenv('DB_NAME'),
+        **options
+    )
+
+def _acquire_connection():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = _create_db_pool()
+        pool = _db_pool
+    return pool, pool.getconn()
+
+@contextmanager
 def get_db_connection():
+    # Без повторов: при недоступной БД обработчики должны завершаться быстро
+    db_breaker.before_call()
+    try:
+        pool, conn = _acquire_connection()
+    except psycopg2.OperationalError:
+        db_breaker.record_failure()
+        raise
+    except Exception:
+        db_breaker.release()
+        raise
+
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+        db_breaker.record_success()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        db_breaker.record_failure()
+        raise
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        db_breaker.record_success()
+        raise
+    finally:
+        pool.putconn(conn, close=broken or conn.closed)
+
+def close_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+
+def init_db():
     max_retries = 3
     retry_delay = 5
-    
+
     for attempt in range(max_retries):
         try:
-            db_url = os.getenv('DATABASE_URL')
-            if db_url:
-                return psycopg2.connect(db_url, sslmode='require')
-            
-            return psycopg2.connect(
-                host=os.getenv('DB_HOST'),
-                port=os.getenv('DB_PORT'),
-                user=os.getenv('DB_USER'),
-                password=os.getenv('DB_PASSWORD'),
-                dbname=os.getenv('DB_NAME'),
-                sslmode='require'
-            )
-        except psycopg2.OperationalError as e:
+            _create_tables()
+            return
+        except DB_UNAVAILABLE_ERRORS as e:
             if attempt == max_retries - 1:
                 raise
             logger.warning(f"Connection failed, retrying in {retry_delay} seconds... (Attempt {attempt + 1}/{max_retries})")
             time.sleep(retry_delay)
+            db_breaker.reset()
 
-def init_db():
+def _create_tables():
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS tenants (
+                        tenant_id SERIAL PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT NOW()
+                    )
+                """)
+                # Данные, созданные до появления цехов, относятся к цеху по умолчанию
+                cursor.execute(
+                    "INSERT INTO tenants (tenant_id, name) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                    (DEFAULT_TENANT_ID, DEFAULT_TENANT_NAME)
+                )
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence('tenants', 'tenant_id'), (SELECT MAX(tenant_id) FROM tenants))"
+                )
+                
                 cursor.execute("""
                     CREATE TABLE IF NOT EXISTS users (
                         user_id BIGINT PRIMARY KEY,
@@ -125,12 +297,101 @@ def init_db():
                         user_id BIGINT PRIMARY KEY
                     )
                 """)
+                
+                for table in TENANT_TABLES:
+                    cursor.execute(sql.SQL("""
+                        ALTER TABLE {} ADD COLUMN IF NOT EXISTS tenant_id INTEGER NOT NULL
+                        DEFAULT {} REFERENCES tenants(tenant_id)
+                    """).format(sql.Identifier(table), sql.Literal(DEFAULT_TENANT_ID)))
+                # Пользователи без доступа ни к одному цеху не относятся
+                cursor.execute("ALTER TABLE users ALTER COLUMN tenant_id DROP NOT NULL, ALTER COLUMN tenant_id DROP DEFAULT")
+                cursor.execute("""
+                    UPDATE users u SET tenant_id = NULL
+                    WHERE u.tenant_id IS NOT NULL
+                      AND NOT EXISTS (SELECT 1 FROM allowed_users a WHERE a.user_id = u.user_id)
+                """)
+                
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS work_types (
+                        work_type_id SERIAL PRIMARY KEY,
+                        tenant_id INTEGER NOT NULL REFERENCES tenants(tenant_id),
+                        name TEXT NOT NULL,
+                        position INTEGER NOT NULL,
+                        UNIQUE (tenant_id, name)
+                    )
+                """)
+                cursor.execute(
+                    SEED_WORK_TYPES_SQL + " WHERE NOT EXISTS (SELECT 1 FROM work_types WHERE tenant_id = %(tenant_id)s)",
+                    {'tenant_id': DEFAULT_TENANT_ID, 'names': WORK_TYPES}
+                )
+                
+                # Покрывающий индекс для постраничного просмотра своих отчетов
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS reports_user_date_id_idx
+                    ON reports (user_id, report_date DESC, report_id DESC)
+                    INCLUDE (work_type, amount, task_id, reported_at)
+                """)
+                # Составные индексы для выборок в пределах цеха
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS reports_tenant_date_idx
+                    ON reports (tenant_id, report_date)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS tasks_tenant_active_idx
+                    ON tasks (tenant_id, is_active, created_at DESC)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS task_works_tenant_task_idx
+                    ON task_works (tenant_id, task_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS users_tenant_idx
+                    ON users (tenant_id, user_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS allowed_users_tenant_idx
+                    ON allowed_users (tenant_id, user_id)
+                """)
                 conn.commit()
     except Exception as e:
         logger.error(f"Error initializing database: {e}")
         raise
 
+# Последние известные права доступа: используются, пока БД недоступна
+_known_admins: Dict[int, bool] = {}
+_known_allowed: Dict[int, bool] = {}
+# Цех пользователя: user_id -> tenant_id, источник - только allowed_users
+_user_tenants: Dict[int, int] = {}
+
+def is_superadmin(user_id: int) -> bool:
+    return SUPERADMIN_ID is not None and str(user_id) == SUPERADMIN_ID
+
+def get_user_tenant(user_id: int) -> int:
+    tenant_id = _user_tenants.get(user_id)
+    if tenant_id is not None:
+        return tenant_id
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT tenant_id FROM allowed_users WHERE user_id = %s", (user_id,))
+                result = cursor.fetchone()
+    except Exception as e:
+        raise TenantUnknownError(f"Cannot resolve tenant of user {user_id}: {e}") from e
+    if not result:
+        raise TenantUnknownError(f"User {user_id} does not belong to any tenant")
+    _user_tenants[user_id] = result[0]
+    return result[0]
+
+def load_user_tenants():
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT user_id, tenant_id FROM allowed_users")
+            tenants = dict(cursor.fetchall())
+    _user_tenants.clear()
+    _user_tenants.update(tenants)
+
 def is_admin(user_id: int) -> bool:
+    # Флаг is_admin действует только в цехе пользователя: выборки администратора ограничены его tenant_id
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
@@ -139,27 +400,160 @@ def is_admin(user_id: int) -> bool:
                     (user_id,)
                 )
                 result = cursor.fetchone()
-                return result and result[0]
+                _known_admins[user_id] = bool(result and result[0])
+                return _known_admins[user_id]
     except Exception as e:
         logger.error(f"Error checking admin status: {e}")
+        return _known_admins.get(user_id, False)
+
+# Каталоги видов работ по цехам: tenant_id -> (время загрузки, [(work_type_id, name), ...])
+WORK_TYPES_CACHE_TTL = 5 * 60
+
+_work_types_cache: Dict[int, Tuple[float, List[Tuple[int, str]]]] = {}
+
+def get_work_types(tenant_id: int) -> List[Tuple[int, str]]:
+    cached = _work_types_cache.get(tenant_id)
+    if cached and time.monotonic() - cached[0] < WORK_TYPES_CACHE_TTL:
+        return cached[1]
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT work_type_id, name FROM work_types WHERE tenant_id = %s ORDER BY position, work_type_id",
+                    (tenant_id,)
+                )
+                work_types = [tuple(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Error loading work types: {e}")
+        # Без БД показываем последний известный каталог
+        return cached[1] if cached else []
+    _work_types_cache[tenant_id] = (time.monotonic(), work_types)
+    return work_types
+
+def get_work_type_name(tenant_id: int, work_type_id: int) -> Optional[str]:
+    for type_id, name in get_work_types(tenant_id):
+        if type_id == work_type_id:
+            return name
+    return None
+
+def legacy_work_type_args(tenant_id: int, args: List[str]) -> List[str]:
+    # Индекс старой кнопки переводим в work_type_id по названию из прежнего списка
+    try:
+        name = WORK_TYPES[int(args[0])]
+    except (IndexError, ValueError):
+        return []
+    for type_id, type_name in get_work_types(tenant_id):
+        if type_name == name:
+            return [str(type_id)]
+    return []
+
+def work_type_keyboard(tenant_id: int, action: str) -> List[List[InlineKeyboardButton]]:
+    work_types = get_work_types(tenant_id)
+    keyboard = []
+    for i in range(0, len(work_types), 2):
+        keyboard.append([
+            InlineKeyboardButton(name, callback_data=cb(action, type_id))
+            for type_id, name in work_types[i:i + 2]
+        ])
+    return keyboard
+
+# Кэш профилей пользователей: user_id -> (username, full_name, время последней записи)
+PROFILE_STALE_SECONDS = 24 * 60 * 60
+PROFILE_FLUSH_INTERVAL = 60
+
+_profile_cache: Dict[int, Tuple[str, str, float]] = {}
+_pending_profiles: Dict[int, Tuple[str, str]] = {}
+_profile_lock = threading.Lock()
+
+# Новый пользователь попадает в цех, куда его добавил администратор; пользователю без доступа цех не назначается
+UPSERT_USERS_SQL = """
+    INSERT INTO users (user_id, username, full_name, tenant_id)
+    SELECT v.user_id, v.username, v.full_name, a.tenant_id
+    FROM (VALUES %s) AS v(user_id, username, full_name)
+    LEFT JOIN allowed_users a ON a.user_id = v.user_id
+    WHERE TRUE
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        full_name = EXCLUDED.full_name
+    WHERE users.username IS DISTINCT FROM EXCLUDED.username
+       OR users.full_name IS DISTINCT FROM EXCLUDED.full_name
+"""
+
+def _profile_is_fresh(user_id: int, username: str, full_name: str) -> bool:
+    cached = _profile_cache.get(user_id)
+    if not cached:
         return False
+    cached_username, cached_full_name, written_at = cached
+    return (
+        cached_username == username
+        and cached_full_name == full_name
+        and time.monotonic() - written_at < PROFILE_STALE_SECONDS
+    )
+
+def _remember_profiles(profiles: Dict[int, Tuple[str, str]]):
+    now = time.monotonic()
+    with _profile_lock:
+        for user_id, (username, full_name) in profiles.items():
+            _profile_cache[user_id] = (username, full_name, now)
+
+def queue_user_profile(user_id: int, username: str, first_name: str, last_name: str) -> bool:
+    """Ставит профиль в очередь на пакетную запись, если он изменился или устарел."""
+    full_name = f"{first_name} {last_name}".strip()
+    with _profile_lock:
+        if _profile_is_fresh(user_id, username, full_name):
+            return False
+        if _pending_profiles.get(user_id) == (username, full_name):
+            return False
+        _pending_profiles[user_id] = (username, full_name)
+        return True
+
+def flush_user_profiles(context: CallbackContext = None):
+    """Записывает накопленные профили одним INSERT ... ON CONFLICT."""
+    global _pending_profiles
+    with _profile_lock:
+        if not _pending_profiles:
+            return
+        pending, _pending_profiles = _pending_profiles, {}
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                execute_values(
+                    cursor,
+                    UPSERT_USERS_SQL,
+                    [(user_id, username, full_name) for user_id, (username, full_name) in pending.items()]
+                )
+                conn.commit()
+        _remember_profiles(pending)
+    except Exception as e:
+        logger.error(f"Error flushing user profiles: {e}")
+        # Возвращаем профили в очередь, не затирая более свежие изменения
+        with _profile_lock:
+            for user_id, profile in pending.items():
+                _pending_profiles.setdefault(user_id, profile)
 
 def register_user(user_id: int, username: str, first_name: str, last_name: str):
     full_name = f"{first_name} {last_name}".strip()
+    with _profile_lock:
+        if _profile_is_fresh(user_id, username, full_name):
+            return
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("""
-                    INSERT INTO users (user_id, username, full_name)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (user_id) DO UPDATE SET
-                        username = EXCLUDED.username,
-                        full_name = EXCLUDED.full_name
-                """, (user_id, username, full_name))
+                execute_values(cursor, UPSERT_USERS_SQL, [(user_id, username, full_name)])
                 conn.commit()
+        with _profile_lock:
+            if _pending_profiles.get(user_id) == (username, full_name):
+                del _pending_profiles[user_id]
+        _remember_profiles({user_id: (username, full_name)})
     except Exception as e:
         logger.error(f"Error registering user: {e}")
 
+def track_user_profile(update: Update, context: CallbackContext):
+    user = update.effective_user
+    if user:
+        queue_user_profile(user.id, user.username, user.first_name, user.last_name)
+
 def start(update: Update, context: CallbackContext) -> int:
     user = update.effective_user
     register_user(user.id, user.username, user.first_name, user.last_name)
@@ -173,12 +567,13 @@ def start(update: Update, context: CallbackContext) -> int:
 def show_main_menu(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id
     keyboard = [
-        [InlineKeyboardButton("📊 Отправить отчет", callback_data='send_report')],
-        [InlineKeyboardButton("📋 Посмотреть задачи", callback_data='view_tasks')]
+        [InlineKeyboardButton("📊 Отправить отчет", callback_data=cb(CB_SEND_REPORT))],
+        [InlineKeyboardButton("📋 Посмотреть задачи", callback_data=cb(CB_VIEW_TASKS))],
+        [InlineKeyboardButton("🗂 Мои отчеты", callback_data=cb(CB_MY_REPORTS))]
     ]
     
     if is_admin(user_id):
-        keyboard.append([InlineKeyboardButton("👨‍💻 Админ-панель", callback_data='admin_panel')])
+        keyboard.append([InlineKeyboardButton("👨‍💻 Админ-панель", callback_data=cb(CB_ADMIN_PANEL))])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -202,7 +597,7 @@ def show_main_menu(update: Update, context: CallbackContext) -> int:
             "Главное меню. Выберите действие:",
             reply_markup=reply_markup
         )
-    return MAIN_MENU
+    return ConversationHandler.END
 
 def cancel(update: Update, context: CallbackContext) -> int:
     try:
@@ -217,7 +612,7 @@ def cancel(update: Update, context: CallbackContext) -> int:
                 update.callback_query.edit_message_text(
                     text="Действие отменено",
                     reply_markup=InlineKeyboardMarkup(
-                        [[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]]
+                        [[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]]
                     )
                 )
             except Exception as e:
@@ -227,13 +622,13 @@ def cancel(update: Update, context: CallbackContext) -> int:
                         chat_id=update.callback_query.message.chat_id,
                         text="Действие отменено",
                         reply_markup=InlineKeyboardMarkup(
-                            [[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]]
+                            [[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]]
                         )
                     )
         return show_main_menu(update, context)
     except Exception as e:
         logger.error(f"Error in cancel function: {e}")
-        return MAIN_MENU
+        return ConversationHandler.END
 
 def admin_panel(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -251,13 +646,13 @@ def admin_panel(update: Update, context: CallbackContext) -> int:
                 chat_id=query.message.chat_id,
                 text="⛔ У вас нет прав администратора."
             )
-        return MAIN_MENU
+        return ConversationHandler.END
     
     keyboard = [
-        [InlineKeyboardButton("📝 Поставить задачу", callback_data='set_task')],
-        [InlineKeyboardButton("📊 Посмотреть отчеты", callback_data='view_reports')],
-        [InlineKeyboardButton("👥 Управление пользователями", callback_data='manage_users')],
-        [InlineKeyboardButton("🔙 Назад", callback_data='main_menu')]
+        [InlineKeyboardButton("📝 Поставить задачу", callback_data=cb(CB_SET_TASK))],
+        [InlineKeyboardButton("📊 Посмотреть отчеты", callback_data=cb(CB_VIEW_REPORTS))],
+        [InlineKeyboardButton("👥 Управление пользователями", callback_data=cb(CB_MANAGE_USERS))],
+        [InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_MAIN_MENU))]
     ]
     
     try:
@@ -272,7 +667,7 @@ def admin_panel(update: Update, context: CallbackContext) -> int:
             text="Админ-панель. Выберите действие:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-    return ADMIN_PANEL
+    return ConversationHandler.END
 
 def set_task(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -288,14 +683,14 @@ def set_task(update: Update, context: CallbackContext) -> int:
     try:
         query.edit_message_text(
             text=f"Название задачи: {context.user_data['task_description']}\n\nВведите общее количество для задачи (целое число):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADMIN_PANEL))]])
         )
     except Exception as e:
         logger.error(f"Error editing message in set_task: {e}")
         context.bot.send_message(
             chat_id=query.message.chat_id,
             text=f"Название задачи: {context.user_data['task_description']}\n\nВведите общее количество для задачи (целое число):",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADMIN_PANEL))]])
         )
     return SET_TASK_AMOUNT
 
@@ -320,29 +715,22 @@ def set_task_amount(update: Update, context: CallbackContext) -> int:
     except ValueError:
         update.message.reply_text(
             "❌ Неверный формат количества. Введите целое положительное число:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADMIN_PANEL))]])
         )
         return SET_TASK_AMOUNT
     except Exception as e:
         logger.error(f"Error in set_task_amount: {e}")
         update.message.reply_text(
             "❌ Произошла ошибка. Попробуйте еще раз.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADMIN_PANEL))]])
         )
         return SET_TASK_AMOUNT
 
 def add_work_type(update: Update, context: CallbackContext) -> int:
-    keyboard = []
-    for i in range(0, len(WORK_TYPES), 2):
-        row = []
-        if i < len(WORK_TYPES):
-            row.append(InlineKeyboardButton(WORK_TYPES[i], callback_data=f'add_work_{i}'))
-        if i+1 < len(WORK_TYPES):
-            row.append(InlineKeyboardButton(WORK_TYPES[i+1], callback_data=f'add_work_{i+1}'))
-        keyboard.append(row)
+    keyboard = work_type_keyboard(get_user_tenant(update.effective_user.id), CB_ADD_WORK)
     
-    keyboard.append([InlineKeyboardButton("✅ Завершить добавление работ", callback_data='finish_adding_works')])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='admin_panel')])
+    keyboard.append([InlineKeyboardButton("✅ Завершить добавление работ", callback_data=cb(CB_FINISH_ADDING_WORKS))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADMIN_PANEL))])
     
     if update.callback_query:
         try:
@@ -374,23 +762,29 @@ def select_work_type(update: Update, context: CallbackContext) -> int:
     except Exception as e:
         logger.error(f"Error answering query in select_work_type: {e}")
     
-    work_type_idx = int(query.data.split('_')[2])
-    context.user_data['current_work_type'] = WORK_TYPES[work_type_idx]
+    work_type = get_work_type_name(get_user_tenant(query.from_user.id), int(context.args[0])) if context.args else None
+    if work_type is None:
+        return add_work_type(update, context)
+    context.user_data['current_work_type'] = work_type
     
     try:
         query.edit_message_text(
-            text=f"Введите количество для работы '{WORK_TYPES[work_type_idx]}':",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='add_work_type')]])
+            text=f"Введите количество для работы '{work_type}':",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADD_WORK_TYPE))]])
         )
     except Exception as e:
         logger.error(f"Error editing message in select_work_type: {e}")
         context.bot.send_message(
             chat_id=query.message.chat_id,
-            text=f"Введите количество для работы '{WORK_TYPES[work_type_idx]}':",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='add_work_type')]])
+            text=f"Введите количество для работы '{work_type}':",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADD_WORK_TYPE))]])
         )
     return SET_WORK_AMOUNT
 
+def select_legacy_work_type(update: Update, context: CallbackContext) -> int:
+    context.args = legacy_work_type_args(get_user_tenant(update.callback_query.from_user.id), context.args)
+    return select_work_type(update, context)
+
 def set_work_amount(update: Update, context: CallbackContext) -> int:
     try:
         if update.message:
@@ -406,7 +800,7 @@ def set_work_amount(update: Update, context: CallbackContext) -> int:
             
             update.message.reply_text(
                 f"✅ Работа '{work_type}' в количестве {amount} добавлена к задаче.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("➕ Добавить еще работу", callback_data='add_work_type')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("➕ Добавить еще работу", callback_data=cb(CB_ADD_WORK_TYPE))]])
             )
             
             return add_work_type(update, context)
@@ -421,14 +815,14 @@ def set_work_amount(update: Update, context: CallbackContext) -> int:
     except ValueError:
         update.message.reply_text(
             "❌ Неверный формат количества. Введите целое положительное число:",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='add_work_type')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADD_WORK_TYPE))]])
         )
         return SET_WORK_AMOUNT
     except Exception as e:
         logger.error(f"Error in set_work_amount: {e}")
         update.message.reply_text(
             "❌ Произошла ошибка. Попробуйте еще раз.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='add_work_type')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADD_WORK_TYPE))]])
         )
         return SET_WORK_AMOUNT
 
@@ -443,14 +837,14 @@ def finish_adding_works(update: Update, context: CallbackContext) -> int:
         try:
             query.edit_message_text(
                 text="❌ Не добавлено ни одной работы. Добавьте хотя бы одну работу.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='add_work_type')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADD_WORK_TYPE))]])
             )
         except Exception as e:
             logger.error(f"Error editing message in finish_adding_works: {e}")
             context.bot.send_message(
                 chat_id=query.message.chat_id,
                 text="❌ Не добавлено ни одной работы. Добавьте хотя бы одну работу.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='add_work_type')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_ADD_WORK_TYPE))]])
             )
         return ADD_WORK_TYPE
     
@@ -463,9 +857,13 @@ def finish_adding_works(update: Update, context: CallbackContext) -> int:
         message += f"- {work['work_type']}: {work['amount']}\n"
     
     keyboard = [
-        [InlineKeyboardButton("✅ Подтвердить", callback_data='confirm_task')],
-        [InlineKeyboardButton("✏️ Редактировать", callback_data='add_work_type')],
-        [InlineKeyboardButton("❌ Отменить", callback_data='admin_panel')]
+        [InlineKeyboardButton("✅ Подтвердить", callback_data=cb(CB_CONFIRM_TASK))],
+        [
+            InlineKeyboardButton(f"✅ Создать ×{copies}", callback_data=cb(CB_CONFIRM_TASK, copies))
+            for copies in TASK_COPY_OPTIONS
+        ],
+        [InlineKeyboardButton("✏️ Редактировать", callback_data=cb(CB_ADD_WORK_TYPE))],
+        [InlineKeyboardButton("❌ Отменить", callback_data=cb(CB_ADMIN_PANEL))]
     ]
     
     try:
@@ -482,6 +880,101 @@ def finish_adding_works(update: Update, context: CallbackContext) -> int:
         )
     return CONFIRM_TASK
 
+# Создание задач вместе с работами одним запросом к БД
+TASK_COPY_OPTIONS = (2, 3, 5)
+MAX_TASK_COPIES = 20
+
+CREATE_TASKS_SQL = """
+    WITH input AS (
+        {input}
+    ), ids AS (
+        SELECT idx, nextval(pg_get_serial_sequence('tasks', 'task_id')) AS task_id FROM input
+    ), new_tasks AS (
+        INSERT INTO tasks (task_id, tenant_id, description, total_amount, created_by)
+        SELECT ids.task_id, %(tenant_id)s, input.description, input.total_amount, %(created_by)s
+        FROM input JOIN ids USING (idx)
+        RETURNING task_id, description, total_amount, created_at, created_by, is_active
+    ), new_works AS (
+        INSERT INTO task_works (task_id, tenant_id, work_type, amount)
+        SELECT ids.task_id, %(tenant_id)s, w.work_type, w.amount
+        FROM input
+        JOIN ids USING (idx)
+        CROSS JOIN LATERAL json_to_recordset(input.works) AS w(work_type TEXT, amount INTEGER)
+        RETURNING work_id, task_id, work_type, amount
+    )
+    SELECT t.task_id, t.description, t.total_amount, t.created_at, t.created_by, t.is_active,
+           COALESCE(
+               json_agg(json_build_object('work_id', w.work_id, 'work_type', w.work_type, 'amount', w.amount)
+                        ORDER BY w.work_id) FILTER (WHERE w.work_id IS NOT NULL),
+               '[]'
+           ) AS works
+    FROM new_tasks t
+    LEFT JOIN new_works w USING (task_id)
+    GROUP BY t.task_id, t.description, t.total_amount, t.created_at, t.created_by, t.is_active
+    ORDER BY t.task_id
+"""
+
+TASKS_FROM_JSON_SQL = """
+    SELECT * FROM json_to_recordset(%(tasks)s::json)
+        AS t(idx INTEGER, description TEXT, total_amount INTEGER, works JSON)
+"""
+
+TASKS_FROM_CLONE_SQL = """
+    SELECT g AS idx, src.description, src.total_amount,
+           COALESCE(
+               (SELECT json_agg(json_build_object('work_type', tw.work_type, 'amount', tw.amount) ORDER BY tw.work_id)
+                FROM task_works tw WHERE tw.task_id = src.task_id),
+               '[]'
+           ) AS works
+    FROM tasks src
+    CROSS JOIN generate_series(1, %(copies)s) AS g
+    WHERE src.task_id = %(source_task_id)s AND src.tenant_id = %(tenant_id)s
+"""
+
+def _run_create_tasks(input_sql: str, params: dict) -> List[dict]:
+    query = sql.SQL(CREATE_TASKS_SQL).format(input=sql.SQL(input_sql))
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cursor:
+            cursor.execute(query, params)
+            tasks = [dict(row) for row in cursor.fetchall()]
+            conn.commit()
+    return tasks
+
+def create_tasks(tasks: List[dict], created_by: int, tenant_id: int = DEFAULT_TENANT_ID) -> List[dict]:
+    """Создает задачи с их работами одним запросом и возвращает созданные строки.
+
+    Каждая задача: {'description', 'total_amount', 'works': [{'work_type', 'amount'}, ...]}.
+    """
+    payload = [
+        {
+            'idx': idx,
+            'description': task['description'],
+            'total_amount': task['total_amount'],
+            'works': [{'work_type': w['work_type'], 'amount': w['amount']} for w in task['works']]
+        }
+        for idx, task in enumerate(tasks)
+    ]
+    return _run_create_tasks(
+        TASKS_FROM_JSON_SQL,
+        {'tasks': json.dumps(payload), 'created_by': created_by, 'tenant_id': tenant_id}
+    )
+
+def clone_task(source_task_id: int, created_by: int, copies: int = 1,
+               tenant_id: int = DEFAULT_TENANT_ID) -> List[dict]:
+    """Создает copies копий задачи цеха tenant_id вместе с ее работами одним запросом."""
+    return _run_create_tasks(
+        TASKS_FROM_CLONE_SQL,
+        {'source_task_id': source_task_id, 'copies': copies, 'created_by': created_by, 'tenant_id': tenant_id}
+    )
+
+def format_created_tasks(tasks: List[dict]) -> str:
+    lines = []
+    for task in tasks:
+        lines.append(f"✅ Задача #{task['task_id']} '{task['description']}' ({task['total_amount']}) создана:")
+        for work in task['works']:
+            lines.append(f"- {work['work_type']}: {work['amount']}")
+    return "\n".join(lines)
+
 def confirm_task(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     try:
@@ -489,55 +982,84 @@ def confirm_task(update: Update, context: CallbackContext) -> int:
     except Exception as e:
         logger.error(f"Error answering query in confirm_task: {e}")
     
+    copies = int(context.args[0]) if context.args else 1
+    # callback_data приходит от клиента: принимаем только количества с кнопок
+    if copies != 1 and copies not in TASK_COPY_OPTIONS:
+        logger.warning(f"Rejected task copies from callback data: {copies}")
+        return CONFIRM_TASK
+    description = context.user_data['task_description']
+    template = {
+        'total_amount': context.user_data['total_amount'],
+        'works': context.user_data['task_works']
+    }
+    if copies == 1:
+        tasks = [dict(template, description=description)]
+    else:
+        tasks = [dict(template, description=f"{description} ({i}/{copies})") for i in range(1, copies + 1)]
+    
     try:
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO tasks (description, total_amount, created_by) VALUES (%s, %s, %s) RETURNING task_id",
-                    (context.user_data['task_description'], 
-                     context.user_data['total_amount'], 
-                     query.from_user.id)
-                )
-                task_id = cursor.fetchone()[0]
-                
-                for work in context.user_data['task_works']:
-                    cursor.execute(
-                        "INSERT INTO task_works (task_id, work_type, amount) VALUES (%s, %s, %s)",
-                        (task_id, work['work_type'], work['amount'])
-                    )
-                
-                conn.commit()
+        created = create_tasks(tasks, query.from_user.id, get_user_tenant(query.from_user.id))
+        text = format_created_tasks(created)
         
         try:
             query.edit_message_text(
-                text=f"✅ Задача '{context.user_data['task_description']}' успешно создана!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data='admin_panel')]])
+                text=text,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data=cb(CB_ADMIN_PANEL))]])
             )
         except Exception as e:
             logger.error(f"Error editing message in confirm_task: {e}")
             context.bot.send_message(
                 chat_id=query.message.chat_id,
-                text=f"✅ Задача '{context.user_data['task_description']}' успешно создана!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data='admin_panel')]])
+                text=text,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data=cb(CB_ADMIN_PANEL))]])
             )
         
         context.user_data.clear()
-        return ADMIN_PANEL
+        return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error creating task: {e}")
         try:
             query.edit_message_text(
                 text="❌ Ошибка при создании задачи. Попробуйте еще раз.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data='admin_panel')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data=cb(CB_ADMIN_PANEL))]])
             )
         except Exception as e:
             logger.error(f"Error editing message in confirm_task (error): {e}")
             context.bot.send_message(
                 chat_id=query.message.chat_id,
                 text="❌ Ошибка при создании задачи. Попробуйте еще раз.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data='admin_panel')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В админ-панель", callback_data=cb(CB_ADMIN_PANEL))]])
             )
-        return ADMIN_PANEL
+        return ConversationHandler.END
+
+def clone_task_command(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    args = context.args or []
+    try:
+        source_task_id = int(args[0])
+        copies = int(args[1]) if len(args) > 1 else 1
+        if not 1 <= copies <= MAX_TASK_COPIES:
+            raise ValueError
+    except (IndexError, ValueError):
+        update.message.reply_text(f"Использование: /clone_task <task_id> [количество копий, до {MAX_TASK_COPIES}]")
+        return
+
+    try:
+        created = clone_task(
+            source_task_id, update.effective_user.id, copies, get_user_tenant(update.effective_user.id)
+        )
+    except Exception as e:
+        logger.error(f"Error cloning task: {e}")
+        update.message.reply_text("❌ Ошибка при копировании задачи.")
+        return
+
+    if not created:
+        update.message.reply_text(f"❌ Задача {source_task_id} не найдена.")
+        return
+    update.message.reply_text(format_created_tasks(created))
 
 def send_report(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -546,16 +1068,8 @@ def send_report(update: Update, context: CallbackContext) -> int:
     except Exception as e:
         logger.error(f"Error answering query in send_report: {e}")
     
-    keyboard = []
-    for i in range(0, len(WORK_TYPES), 2):
-        row = []
-        if i < len(WORK_TYPES):
-            row.append(InlineKeyboardButton(WORK_TYPES[i], callback_data=f'report_work_{i}'))
-        if i+1 < len(WORK_TYPES):
-            row.append(InlineKeyboardButton(WORK_TYPES[i+1], callback_data=f'report_work_{i+1}'))
-        keyboard.append(row)
-    
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='main_menu')])
+    keyboard = work_type_keyboard(get_user_tenant(query.from_user.id), CB_REPORT_WORK)
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_MAIN_MENU))])
     
     try:
         query.edit_message_text(
@@ -571,6 +1085,10 @@ def send_report(update: Update, context: CallbackContext) -> int:
         )
     return REPORT_WORK_TYPE
 
+def report_legacy_work_type(update: Update, context: CallbackContext) -> int:
+    context.args = legacy_work_type_args(get_user_tenant(update.callback_query.from_user.id), context.args)
+    return report_work_type(update, context)
+
 def report_work_type(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     try:
@@ -578,24 +1096,33 @@ def report_work_type(update: Update, context: CallbackContext) -> int:
     except Exception as e:
         logger.error(f"Error answering query in report_work_type: {e}")
     
-    work_type_idx = int(query.data.split('_')[2])
-    work_type = WORK_TYPES[work_type_idx]
+    tenant_id = get_user_tenant(query.from_user.id)
+    work_type = get_work_type_name(tenant_id, int(context.args[0])) if context.args else None
+    if work_type is None:
+        return send_report(update, context)
     context.user_data['report_work_type'] = work_type
     
-    with get_db_connection() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT task_id, description FROM tasks WHERE is_active = TRUE ORDER BY created_at DESC
-            """)
-            tasks = cursor.fetchall()
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT task_id, description FROM tasks
+                    WHERE tenant_id = %s AND is_active = TRUE
+                    ORDER BY created_at DESC
+                """, (tenant_id,))
+                tasks = cursor.fetchall()
+    except DB_UNAVAILABLE_ERRORS as e:
+        # Без БД список задач недоступен, отчет принимаем без задачи
+        logger.warning(f"Database unavailable in report_work_type: {e}")
+        tasks = []
     
     if tasks:
         keyboard = []
         for task in tasks:
-            keyboard.append([InlineKeyboardButton(task[1], callback_data=f'report_task_{task[0]}')])
+            keyboard.append([InlineKeyboardButton(task[1], callback_data=cb(CB_REPORT_TASK, task[0]))])
         
-        keyboard.append([InlineKeyboardButton("📌 Без задачи", callback_data='report_without_task')])
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data='send_report')])
+        keyboard.append([InlineKeyboardButton("📌 Без задачи", callback_data=cb(CB_REPORT_WITHOUT_TASK))])
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_SEND_REPORT))])
         
         try:
             query.edit_message_text(
@@ -614,14 +1141,14 @@ def report_work_type(update: Update, context: CallbackContext) -> int:
         try:
             query.edit_message_text(
                 text=f"Введите количество выполненной работы '{work_type}':",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='send_report')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_SEND_REPORT))]])
             )
         except Exception as e:
             logger.error(f"Error editing message in report_work_type (no tasks): {e}")
             context.bot.send_message(
                 chat_id=query.message.chat_id,
                 text=f"Введите количество выполненной работы '{work_type}':",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='send_report')]])
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_SEND_REPORT))]])
             )
         return REPORT_AMOUNT
     
@@ -634,26 +1161,170 @@ def select_task_for_report(update: Update, context: CallbackContext) -> int:
     except Exception as e:
         logger.error(f"Error answering query in select_task_for_report: {e}")
     
-    if query.data == 'report_without_task':
+    if not context.args:
         context.user_data['report_task_id'] = None
     else:
-        task_id = int(query.data.split('_')[2])
+        task_id = int(context.args[0])
         context.user_data['report_task_id'] = task_id
     
     try:
         query.edit_message_text(
             text=f"Введите количество выполненной работы '{context.user_data['report_work_type']}':",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='send_report')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_SEND_REPORT))]])
         )
     except Exception as e:
         logger.error(f"Error editing message in select_task_for_report: {e}")
         context.bot.send_message(
             chat_id=query.message.chat_id,
             text=f"Введите количество выполненной работы '{context.user_data['report_work_type']}':",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='send_report')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_SEND_REPORT))]])
         )
     return REPORT_AMOUNT
 
+# Локальная очередь отчетов на время недоступности БД
+REPORT_QUEUE_FILE = os.getenv('REPORT_QUEUE_FILE', 'pending_reports.jsonl')
+REPORT_REPLAY_INTERVAL = 30
+# Отчеты, которые БД отклонила при повторной отправке (не из-за недоступности)
+REPORT_REJECTED_FILE = os.getenv('REPORT_REJECTED_FILE', 'rejected_reports.jsonl')
+
+_report_queue_lock = threading.Lock()
+_report_replay_lock = threading.Lock()
+
+def insert_reports(reports: List[dict]) -> List[int]:
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            rows = execute_values(
+                cursor,
+                """
+                    INSERT INTO reports (tenant_id, user_id, task_id, work_type, amount, report_date, reported_at)
+                    VALUES %s RETURNING report_id
+                """,
+                [
+                    (r.get('tenant_id', DEFAULT_TENANT_ID), r['user_id'], r['task_id'], r['work_type'],
+                     r['amount'], r['report_date'], r.get('reported_at'))
+                    for r in reports
+                ],
+                # Окно изменения отчета проверяется по NOW() базы, поэтому время по умолчанию тоже берется из БД.
+                # Время хоста передается только для отчетов из локальной очереди
+                template="(%s, %s, %s, %s, %s, %s, COALESCE(%s::TIMESTAMP, NOW()))",
+                fetch=True
+            )
+            conn.commit()
+    report_ids = [row[0] for row in rows]
+    for report_id, r in zip(report_ids, reports):
+        # Хранилище цеха, которое еще не создано, прочитает отчет из БД при первом обращении
+        store = report_stores.get(r.get('tenant_id', DEFAULT_TENANT_ID))
+        if store is None:
+            continue
+        store.append(
+            report_id, r['user_id'], r['work_type'],
+            datetime.strptime(r['report_date'], '%Y-%m-%d').date(), r['amount']
+        )
+    return report_ids
+
+def queue_report_locally(report: dict):
+    with _report_queue_lock:
+        with open(REPORT_QUEUE_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False) + '\n')
+
+def _read_report_queue() -> List[dict]:
+    if not os.path.exists(REPORT_QUEUE_FILE):
+        return []
+    with open(REPORT_QUEUE_FILE, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def pending_report_count() -> int:
+    with _report_queue_lock:
+        return len(_read_report_queue())
+
+def _drop_replayed_reports(count: int):
+    # Пока шла вставка, в конец очереди могли дописать новые отчеты
+    with _report_queue_lock:
+        remaining = _read_report_queue()[count:]
+        if not remaining:
+            os.remove(REPORT_QUEUE_FILE)
+            return
+        with open(REPORT_QUEUE_FILE, 'w', encoding='utf-8') as f:
+            for report in remaining:
+                f.write(json.dumps(report, ensure_ascii=False) + '\n')
+
+def reject_queued_report(report: dict, error: Exception):
+    logger.error(f"Queued report rejected by database, moved to {REPORT_REJECTED_FILE}: {error}")
+    with open(REPORT_REJECTED_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(dict(report, error=str(error)), ensure_ascii=False) + '\n')
+
+def _replay_one_by_one(reports: List[dict]) -> int:
+    for i, report in enumerate(reports):
+        try:
+            insert_reports([report])
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.warning(f"Replay of queued reports interrupted: {e}")
+            return i
+        except Exception as e:
+            reject_queued_report(report, e)
+    return len(reports)
+
+def replay_queued_reports(context: CallbackContext = None):
+    if db_breaker.state == CircuitBreaker.OPEN:
+        return
+    if not _report_replay_lock.acquire(blocking=False):
+        return
+    try:
+        with _report_queue_lock:
+            reports = _read_report_queue()
+        if not reports:
+            return
+
+        # Профили, накопленные за время сбоя, нужны для внешнего ключа reports.user_id
+        flush_user_profiles()
+        try:
+            insert_reports(reports)
+            replayed = len(reports)
+        except DB_UNAVAILABLE_ERRORS as e:
+            logger.warning(f"Replay of queued reports failed: {e}")
+            return
+        except Exception as e:
+            # Одна ошибочная строка не должна навсегда блокировать остальные
+            logger.warning(f"Batch replay of queued reports failed, retrying one by one: {e}")
+            replayed = _replay_one_by_one(reports)
+
+        # Файл очереди сокращается только после коммита: сбой до этого момента отчеты не теряет
+        _drop_replayed_reports(replayed)
+        logger.info(f"Replayed {replayed} locally queued reports")
+    finally:
+        _report_replay_lock.release()
+
+def update_backlog(dispatcher) -> Dict[Optional[int], int]:
+    # Необработанные обновления по цехам; у диспетчера replay.py очереди нет
+    update_queue = dispatcher.update_queue
+    if isinstance(update_queue, FairUpdateQueue):
+        return update_queue.backlog()
+    return {None: update_queue.qsize()} if update_queue is not None else {}
+
+def health(update: Update, context: CallbackContext):
+    if not is_admin(update.effective_user.id):
+        update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    stats = db_breaker.stats()
+    mode = "штатный" if stats['state'] == CircuitBreaker.CLOSED else "деградированный"
+    update.message.reply_text(
+        f"🩺 Состояние бота: {mode}\n"
+        f"- БД: {stats['state']}\n"
+        f"- Ошибок подряд: {stats['consecutive_failures']}\n"
+        f"- Всего ошибок БД: {stats['total_failures']}\n"
+        f"- Отклонено без обращения к БД: {stats['total_rejected']}\n"
+        f"- Отчетов в локальной очереди: {pending_report_count()}\n"
+        f"- Обновлений в очереди: {sum(update_backlog(context.dispatcher).values())}"
+    )
+
+def log_health(context: CallbackContext):
+    stats = db_breaker.stats()
+    logger.info(
+        f"Health: {stats}, queued_reports={pending_report_count()}, "
+        f"update_backlog={update_backlog(context.dispatcher)}"
+    )
+
 def save_report(update: Update, context: CallbackContext) -> int:
     try:
         if update.message:
@@ -666,25 +1337,34 @@ def save_report(update: Update, context: CallbackContext) -> int:
             user_id = update.message.from_user.id
             report_date = datetime.now().date()
             
-            with get_db_connection() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(
-                        "INSERT INTO reports (user_id, task_id, work_type, amount, report_date) VALUES (%s, %s, %s, %s, %s)",
-                        (user_id, task_id, work_type, amount, report_date)
-                    )
-                    conn.commit()
+            report = {
+                'tenant_id': get_user_tenant(user_id),
+                'user_id': user_id,
+                'task_id': task_id,
+                'work_type': work_type,
+                'amount': amount,
+                'report_date': report_date.isoformat(),
+                'reported_at': None
+            }
+            try:
+                insert_reports([report])
+                saved_info = "успешно сохранен"
+            except DB_UNAVAILABLE_ERRORS as e:
+                logger.warning(f"Database unavailable, queueing report locally: {e}")
+                queue_report_locally(dict(report, reported_at=datetime.now().isoformat()))
+                saved_info = "принят и будет сохранен, когда база данных станет доступна"
             
             keyboard = [
-                [InlineKeyboardButton("➕ Добавить еще работу", callback_data='send_report')],
-                [InlineKeyboardButton("🔙 В главное меню", callback_data='main_menu')]
+                [InlineKeyboardButton("➕ Добавить еще работу", callback_data=cb(CB_SEND_REPORT))],
+                [InlineKeyboardButton("🔙 В главное меню", callback_data=cb(CB_MAIN_MENU))]
             ]
             
             task_info = f" к задаче {task_id}" if task_id else " (без задачи)"
             update.message.reply_text(
-                f"✅ Отчет по работе '{work_type}'{task_info} в количестве {amount} успешно сохранен!",
+                f"✅ Отчет по работе '{work_type}'{task_info} в количестве {amount} {saved_info}!",
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
-            return MAIN_MENU
+            return ConversationHandler.END
         else:
             if update.callback_query:
                 try:
@@ -696,56 +1376,782 @@ def save_report(update: Update, context: CallbackContext) -> int:
     except ValueError:
         update.message.reply_text(
             "❌ Неверный формат количества. Введите целое число больше 0.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data='send_report')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_SEND_REPORT))]])
         )
         return REPORT_AMOUNT
     except Exception as e:
         logger.error(f"Error saving report: {e}")
         update.message.reply_text(
             "❌ Ошибка при сохранении отчета.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data='main_menu')]])
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data=cb(CB_MAIN_MENU))]])
+        )
+        return ConversationHandler.END
+
+# Просмотр своих отчетов: keyset-пагинация по (report_date, report_id), один запрос на страницу
+MY_REPORTS_PAGE_SIZE = 10
+REPORT_EDIT_WINDOW_SECONDS = 30 * 60
+
+MY_REPORTS_PAGE_SQL = """
+    WITH page AS (
+        SELECT report_id, report_date, work_type, amount, task_id,
+               reported_at > NOW() - %(window)s * INTERVAL '1 second' AS editable
+        FROM reports
+        WHERE user_id = %(user_id)s
+          AND (%(before_date)s::DATE IS NULL OR (report_date, report_id) < (%(before_date)s::DATE, %(before_id)s))
+        ORDER BY report_date DESC, report_id DESC
+        LIMIT %(limit)s
+    ), days AS (
+        SELECT report_date, SUM(amount) AS day_total
+        FROM reports
+        WHERE user_id = %(user_id)s
+          AND report_date IN (SELECT report_date FROM page)
+        GROUP BY report_date
+    )
+    SELECT page.*, days.day_total
+    FROM page JOIN days USING (report_date)
+    ORDER BY report_date DESC, report_id DESC
+"""
+
+# Изменять и удалять можно только последний отчет пользователя и только в пределах окна
+LAST_REPORT_CONDITION = """
+    report_id = %(report_id)s
+    AND user_id = %(user_id)s
+    AND reported_at > NOW() - %(window)s * INTERVAL '1 second'
+    AND report_id = (
+        SELECT report_id FROM reports WHERE user_id = %(user_id)s
+        ORDER BY report_date DESC, report_id DESC LIMIT 1
+    )
+"""
+
+def fetch_report_page(user_id: int, before: Optional[Tuple[date, int]]) -> Tuple[List[dict], bool]:
+    before_date, before_id = before if before else (None, None)
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=DictCursor) as cursor:
+            cursor.execute(MY_REPORTS_PAGE_SQL, {
+                'user_id': user_id,
+                'before_date': before_date,
+                'before_id': before_id,
+                'limit': MY_REPORTS_PAGE_SIZE + 1,
+                'window': REPORT_EDIT_WINDOW_SECONDS,
+            })
+            rows = [dict(row) for row in cursor.fetchall()]
+    return rows[:MY_REPORTS_PAGE_SIZE], len(rows) > MY_REPORTS_PAGE_SIZE
+
+def _edit_or_send(update: Update, context: CallbackContext, text: str, keyboard: list):
+    query = update.callback_query
+    try:
+        query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+        context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=text,
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
+
+def my_reports(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in my_reports: {e}")
+
+    user_id = query.from_user.id
+    before = None
+    if len(context.args) == 2:
+        before = (datetime.strptime(context.args[0], '%Y%m%d').date(), int(context.args[1]))
+
+    try:
+        rows, has_more = fetch_report_page(user_id, before)
+    except Exception as e:
+        logger.error(f"Error fetching reports page: {e}")
+        _edit_or_send(update, context, "❌ Не удалось загрузить отчеты. Попробуйте позже.",
+                      [[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
+        return MAIN_MENU
+
+    if not rows:
+        text = "🗂 Отчетов пока нет." if before is None else "🗂 Более ранних отчетов нет."
+    else:
+        lines = ["🗂 Мои отчеты:"]
+        current_date = None
+        for row in rows:
+            if row['report_date'] != current_date:
+                current_date = row['report_date']
+                lines.append(f"\n📅 {current_date.strftime('%d.%m.%Y')} — всего {row['day_total']}")
+            task_info = f" (задача {row['task_id']})" if row['task_id'] else ""
+            lines.append(f"- {row['work_type']}: {row['amount']}{task_info}")
+        text = "\n".join(lines)
+
+    keyboard = []
+    if before is None and rows and rows[0]['editable']:
+        last_id = rows[0]['report_id']
+        keyboard.append([
+            InlineKeyboardButton("✏️ Изменить последний", callback_data=cb(CB_EDIT_LAST_REPORT, last_id)),
+            InlineKeyboardButton("🗑 Удалить последний", callback_data=cb(CB_DELETE_LAST_REPORT, last_id))
+        ])
+    navigation = []
+    if before is not None:
+        navigation.append(InlineKeyboardButton("⏮ К последним", callback_data=cb(CB_MY_REPORTS)))
+    if has_more:
+        last = rows[-1]
+        navigation.append(InlineKeyboardButton(
+            "Ранее ▶️",
+            callback_data=cb(CB_MY_REPORTS, last['report_date'].strftime('%Y%m%d'), last['report_id'])
+        ))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))])
+
+    _edit_or_send(update, context, text, keyboard)
+    return MAIN_MENU
+
+def delete_last_report(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in delete_last_report: {e}")
+
+    report_id = int(context.args[0])
+    if len(context.args) < 2:
+        _edit_or_send(update, context, "Удалить последний отчет?", [[
+            InlineKeyboardButton("🗑 Да, удалить", callback_data=cb(CB_DELETE_LAST_REPORT, report_id, 1)),
+            InlineKeyboardButton("Отмена", callback_data=cb(CB_MY_REPORTS))
+        ]])
         return MAIN_MENU
 
-def is_user_allowed(user_id: int) -> bool:
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    "SELECT 1 FROM allowed_users WHERE user_id = %s", 
-                    (user_id,)
+                    f"DELETE FROM reports WHERE {LAST_REPORT_CONDITION} RETURNING work_type, amount",
+                    {'report_id': report_id, 'user_id': query.from_user.id, 'window': REPORT_EDIT_WINDOW_SECONDS}
                 )
-                return cursor.fetchone() is not None
+                deleted = cursor.fetchone()
+                conn.commit()
     except Exception as e:
-        logger.error(f"Error checking allowed user: {e}")
-        return False
+        logger.error(f"Error deleting report: {e}")
+        deleted = None
 
-def unknown_message(update: Update, context: CallbackContext) -> int:
-    if update.message:
-        update.message.reply_text(
-            "Я не понимаю эту команду. Используйте кнопки меню.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]])
-        )
-    elif update.callback_query:
-        try:
-            update.callback_query.answer()
-            update.callback_query.edit_message_text(
-                text="Я не понимаю эту команду. Используйте кнопки меню.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]])
-            )
-        except Exception as e:
-            logger.error(f"Error in unknown_message (callback): {e}")
-            if update.callback_query.message:
-                context.bot.send_message(
-                    chat_id=update.callback_query.message.chat_id,
-                    text="Я не понимаю эту команду. Используйте кнопки меню.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]])
-                )
+    back = [[InlineKeyboardButton("🗂 Мои отчеты", callback_data=cb(CB_MY_REPORTS))]]
+    if deleted:
+        # report_id уникален во всех цехах: обновляем хранилища без определения цеха
+        for store in list(report_stores.values()):
+            store.remove(report_id)
+        _edit_or_send(update, context, f"🗑 Отчет '{deleted[0]}' ({deleted[1]}) удален.", back)
+    else:
+        _edit_or_send(update, context, "❌ Отчет нельзя удалить: время на изменение истекло.", back)
     return MAIN_MENU
 
-def error_handler(update: Update, context: CallbackContext):
+def edit_last_report(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in edit_last_report: {e}")
+
+    context.user_data['edit_report_id'] = int(context.args[0])
+    _edit_or_send(update, context, "Введите новое количество для последнего отчета:",
+                  [[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_MY_REPORTS))]])
+    return EDIT_REPORT_AMOUNT
+
+def save_edited_report(update: Update, context: CallbackContext) -> int:
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("🗂 Мои отчеты", callback_data=cb(CB_MY_REPORTS))]])
+    try:
+        amount = int(update.message.text.strip())
+        if amount <= 0:
+            raise ValueError
+    except ValueError:
+        update.message.reply_text(
+            "❌ Неверный формат количества. Введите целое число больше 0.",
+            reply_markup=back
+        )
+        return EDIT_REPORT_AMOUNT
+
+    report_id = context.user_data.pop('edit_report_id', None)
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE reports SET amount = %(amount)s WHERE {LAST_REPORT_CONDITION} RETURNING work_type",
+                    {
+                        'amount': amount,
+                        'report_id': report_id,
+                        'user_id': update.message.from_user.id,
+                        'window': REPORT_EDIT_WINDOW_SECONDS
+                    }
+                )
+                updated = cursor.fetchone()
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Error editing report: {e}")
+        updated = None
+
+    if updated:
+        for store in list(report_stores.values()):
+            store.update_amount(report_id, amount)
+        update.message.reply_text(f"✅ Отчет '{updated[0]}' изменен: {amount}.", reply_markup=back)
+    else:
+        update.message.reply_text("❌ Отчет нельзя изменить: время на изменение истекло.", reply_markup=back)
+    return ConversationHandler.END
+
+def cancel_edit_report(update: Update, context: CallbackContext) -> int:
+    context.user_data.pop('edit_report_id', None)
+    my_reports(update, context)
+    return ConversationHandler.END
+
+TASKS_VIEW_LIMIT = 20
+
+def view_tasks(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in view_tasks: {e}")
+
+    back = [[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]]
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT t.task_id, t.description, t.total_amount, tw.work_type, tw.amount,
+                           (SELECT COALESCE(SUM(r.amount), 0) FROM reports r
+                            WHERE r.task_id = t.task_id AND r.work_type = tw.work_type)
+                    FROM (
+                        SELECT task_id, description, total_amount, created_at FROM tasks
+                        WHERE tenant_id = %s AND is_active = TRUE
+                        ORDER BY created_at DESC
+                        LIMIT %s
+                    ) t
+                    LEFT JOIN task_works tw ON tw.task_id = t.task_id
+                    ORDER BY t.created_at DESC, t.task_id, tw.work_id
+                """, (get_user_tenant(query.from_user.id), TASKS_VIEW_LIMIT))
+                rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Error loading tasks: {e}")
+        _edit_or_send(update, context, "❌ Ошибка при загрузке задач.", back)
+        return MAIN_MENU
+
+    if not rows:
+        _edit_or_send(update, context, "Активных задач нет.", back)
+        return MAIN_MENU
+
+    lines = ["📋 Активные задачи:"]
+    current_task = None
+    for task_id, description, total_amount, work_type, amount, done in rows:
+        if task_id != current_task:
+            current_task = task_id
+            lines.append(f"\n🔹 Задача {task_id}: {description} ({total_amount} шт.)")
+        if work_type:
+            lines.append(f"- {work_type}: {done}/{amount}")
+
+    _edit_or_send(update, context, "\n".join(lines)[:4000], back)
+    return MAIN_MENU
+
+def view_reports(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in view_reports: {e}")
+
+    back = [[InlineKeyboardButton("🔙 В админ-панель", callback_data=cb(CB_ADMIN_PANEL))]]
+    if not is_admin(query.from_user.id):
+        _edit_or_send(update, context, "⛔ У вас нет прав администратора.", back)
+        return MAIN_MENU
+
+    today = datetime.now().date()
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT user_id, work_type, SUM(amount) FROM reports
+                    WHERE tenant_id = %s AND report_date = %s
+                    GROUP BY user_id, work_type
+                    ORDER BY user_id, work_type
+                """, (get_user_tenant(query.from_user.id), today))
+                rows = cursor.fetchall()
+        names = get_user_names(sorted({row[0] for row in rows}))
+    except Exception as e:
+        logger.error(f"Error loading reports: {e}")
+        _edit_or_send(update, context, "❌ Ошибка при загрузке отчетов.", back)
+        return ADMIN_PANEL
+
+    if not rows:
+        _edit_or_send(update, context, f"За {today.strftime('%d.%m.%Y')} отчетов нет.", back)
+        return ADMIN_PANEL
+
+    lines = [f"📊 Отчеты за {today.strftime('%d.%m.%Y')}:"]
+    current_user = None
+    for user_id, work_type, total in rows:
+        if user_id != current_user:
+            current_user = user_id
+            lines.append(f"\n👤 {names.get(user_id, user_id)}")
+        lines.append(f"- {work_type}: {total}")
+
+    _edit_or_send(update, context, "\n".join(lines)[:4000], back)
+    return ADMIN_PANEL
+
+def manage_users(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in manage_users: {e}")
+
+    back = [[InlineKeyboardButton("🔙 В админ-панель", callback_data=cb(CB_ADMIN_PANEL))]]
+    if not is_admin(query.from_user.id):
+        _edit_or_send(update, context, "⛔ У вас нет прав администратора.", back)
+        return ConversationHandler.END
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT a.user_id, COALESCE(NULLIF(u.full_name, ''), u.username, a.user_id::TEXT)
+                    FROM allowed_users a
+                    LEFT JOIN users u ON u.user_id = a.user_id
+                    WHERE a.tenant_id = %s
+                    ORDER BY a.user_id
+                """, (get_user_tenant(query.from_user.id),))
+                users = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Error loading allowed users: {e}")
+        _edit_or_send(update, context, "❌ Ошибка при загрузке пользователей.", back)
+        return ConversationHandler.END
+
+    lines = ["👥 Пользователи цеха:"]
+    lines += [f"- {name} ({user_id})" for user_id, name in users] or ["- пока никого"]
+    keyboard = [
+        [InlineKeyboardButton("➕ Добавить", callback_data=cb(CB_ADD_USER)),
+         InlineKeyboardButton("➖ Удалить", callback_data=cb(CB_REMOVE_USER))]
+    ] + back
+    _edit_or_send(update, context, "\n".join(lines)[:4000], keyboard)
+    return ConversationHandler.END
+
+def add_user(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in add_user: {e}")
+
+    if not is_admin(query.from_user.id):
+        _edit_or_send(update, context, "⛔ У вас нет прав администратора.", [])
+        return ConversationHandler.END
+
+    _edit_or_send(update, context, "Введите ID пользователя, которого нужно добавить:",
+                  [[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_MANAGE_USERS))]])
+    return ADD_USER
+
+def add_user_handler(update: Update, context: CallbackContext) -> int:
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("👥 К пользователям", callback_data=cb(CB_MANAGE_USERS))]])
+    try:
+        user_id = int(update.message.text.strip())
+    except ValueError:
+        update.message.reply_text("❌ ID пользователя должен быть числом. Попробуйте еще раз.", reply_markup=back)
+        return ADD_USER
+
+    tenant_id = get_user_tenant(update.message.from_user.id)
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                # Пользователь из другого цеха не переносится: это делает только главный администратор
+                cursor.execute("""
+                    INSERT INTO allowed_users (user_id, tenant_id) VALUES (%s, %s)
+                    ON CONFLICT (user_id) DO NOTHING
+                    RETURNING user_id
+                """, (user_id, tenant_id))
+                added = cursor.fetchone() is not None
+                if not added:
+                    cursor.execute("SELECT tenant_id FROM allowed_users WHERE user_id = %s", (user_id,))
+                    existing = cursor.fetchone()
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Error adding user: {e}")
+        update.message.reply_text("❌ Ошибка при добавлении пользователя.", reply_markup=back)
+        return ConversationHandler.END
+
+    if added:
+        _known_allowed[user_id] = True
+        _user_tenants[user_id] = tenant_id
+        update.message.reply_text(f"✅ Пользователь {user_id} добавлен.", reply_markup=back)
+    elif existing and existing[0] == tenant_id:
+        update.message.reply_text(f"Пользователь {user_id} уже есть в списке.", reply_markup=back)
+    else:
+        update.message.reply_text(f"❌ Пользователь {user_id} уже состоит в другом цехе.", reply_markup=back)
+    return ConversationHandler.END
+
+def remove_user(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query
+    try:
+        query.answer()
+    except Exception as e:
+        logger.error(f"Error answering query in remove_user: {e}")
+
+    if not is_admin(query.from_user.id):
+        _edit_or_send(update, context, "⛔ У вас нет прав администратора.", [])
+        return ConversationHandler.END
+
+    _edit_or_send(update, context, "Введите ID пользователя, которого нужно удалить:",
+                  [[InlineKeyboardButton("🔙 Назад", callback_data=cb(CB_MANAGE_USERS))]])
+    return REMOVE_USER
+
+def remove_user_handler(update: Update, context: CallbackContext) -> int:
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("👥 К пользователям", callback_data=cb(CB_MANAGE_USERS))]])
+    try:
+        user_id = int(update.message.text.strip())
+    except ValueError:
+        update.message.reply_text("❌ ID пользователя должен быть числом. Попробуйте еще раз.", reply_markup=back)
+        return REMOVE_USER
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM allowed_users WHERE user_id = %s AND tenant_id = %s RETURNING user_id",
+                    (user_id, get_user_tenant(update.message.from_user.id))
+                )
+                removed = cursor.fetchone() is not None
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Error removing user: {e}")
+        update.message.reply_text("❌ Ошибка при удалении пользователя.", reply_markup=back)
+        return ConversationHandler.END
+
+    if removed:
+        _known_allowed[user_id] = False
+        _user_tenants.pop(user_id, None)
+        update.message.reply_text(f"✅ Пользователь {user_id} удален.", reply_markup=back)
+    else:
+        update.message.reply_text(f"❌ Пользователь {user_id} не найден в вашем цехе.", reply_markup=back)
+    return ConversationHandler.END
+
+def get_report_store(tenant_id: int) -> ReportStore:
+    store = report_stores.get(tenant_id)
+    if store is None or not store.loaded:
+        with _report_store_load_lock:
+            store = report_stores.get(tenant_id)
+            if store is None or not store.loaded:
+                store = ReportStore([name for _, name in get_work_types(tenant_id)])
+                # Хранилище публикуется до выборки: отчеты, сохраненные во время загрузки, не теряются
+                report_stores[tenant_id] = store
+                try:
+                    with get_db_connection() as conn:
+                        store.load(conn, tenant_id)
+                except Exception:
+                    report_stores.pop(tenant_id, None)
+                    raise
+                logger.info(f"Report store for tenant {tenant_id} loaded: {len(store)} reports")
+    return store
+
+def get_user_names(user_ids: List[int]) -> Dict[int, str]:
+    if not user_ids:
+        return {}
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT user_id, COALESCE(NULLIF(full_name, ''), username, user_id::TEXT) FROM users WHERE user_id = ANY(%s)",
+                (list(user_ids),)
+            )
+            return dict(cursor.fetchall())
+
+def format_delta(current: int, previous: int) -> str:
+    if not previous:
+        return "новое" if current else "0"
+    change = (current - previous) * 100 / previous
+    return f"{change:+.0f}%"
+
+def activity(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    args = context.args or []
+    period = args[0] if args else 'week'
+    if period not in ACTIVITY_PERIODS:
+        update.message.reply_text("Использование: /activity [week|month] [user_id]")
+        return
+    target_user = None
+    if len(args) > 1:
+        try:
+            target_user = int(args[1])
+        except ValueError:
+            update.message.reply_text("❌ user_id должен быть числом.")
+            return
+
+    try:
+        store = get_report_store(get_user_tenant(user_id))
+        comparison = store.compare_periods(datetime.now().date(), ACTIVITY_PERIODS[period], target_user)
+        names = get_user_names(sorted({uid for uid, _ in comparison}))
+    except Exception as e:
+        logger.error(f"Error building activity report: {e}")
+        update.message.reply_text("❌ Ошибка при построении статистики.")
+        return
+
+    if not comparison:
+        update.message.reply_text("Нет отчетов за выбранный период.")
+        return
+
+    title = "неделю" if period == 'week' else "месяц"
+    lines = [f"📈 Активность за {title} (к предыдущему периоду):"]
+    by_user: Dict[int, List[Tuple[str, int, int]]] = {}
+    for (uid, work_type), (current, previous) in comparison.items():
+        by_user.setdefault(uid, []).append((work_type, current, previous))
+
+    for uid in sorted(by_user, key=lambda u: -sum(c for _, c, _ in by_user[u])):
+        lines.append(f"\n👤 {names.get(uid, uid)}")
+        for work_type, current, previous in sorted(by_user[uid]):
+            lines.append(f"- {work_type}: {current} (было {previous}, {format_delta(current, previous)})")
+
+    text = "\n".join(lines)
+    # Ограничение Telegram на длину сообщения
+    for i in range(0, len(text), 4000):
+        update.message.reply_text(text[i:i + 4000])
+
+def chart(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    args = context.args or []
+    by = args[0] if args else 'types'
+    try:
+        days = int(args[1]) if len(args) > 1 else 14
+    except ValueError:
+        days = 0
+    if by not in ('types', 'workers') or not 1 <= days <= CHART_MAX_DAYS:
+        update.message.reply_text(f"Использование: /chart [types|workers] [дней, до {CHART_MAX_DAYS}]")
+        return
+
+    try:
+        tenant_id = get_user_tenant(user_id)
+        store = get_report_store(tenant_id)
+        end = datetime.now().date() + timedelta(days=1)
+        start = end - timedelta(days=days)
+        # Версия данных в ключе: график перерисовывается только после новых отчетов.
+        # Версии хранилищ разных цехов совпадают, поэтому цех тоже входит в ключ
+        key = ('daily', tenant_id, by, start, end, store.version)
+
+        def build():
+            dates, series = store.daily_series(
+                start, end, 'work_type' if by == 'types' else 'user', CHART_MAX_SERIES
+            )
+            if by == 'workers':
+                names = get_user_names(list(series))
+                series = {str(names.get(uid, uid)): values for uid, values in series.items()}
+            title = "по видам работ" if by == 'types' else "по работникам"
+            return f"Выработка {title} за {days} дн.", dates, series
+
+        future = submit_chart(key, build)
+    except Exception as e:
+        logger.error(f"Error building chart: {e}")
+        update.message.reply_text("❌ Ошибка при построении графика.")
+        return
+
+    chat_id = update.effective_chat.id
+
+    def send(done):
+        try:
+            context.bot.send_photo(chat_id=chat_id, photo=done.result())
+        except Exception as e:
+            logger.error(f"Error sending chart: {e}")
+            context.bot.send_message(chat_id=chat_id, text="❌ Ошибка при построении графика.")
+
+    # Колбэк Future выполняется в служебном потоке пула процессов: отправку отдаем потокам диспетчера
+    future.add_done_callback(lambda done: context.dispatcher.run_async(send, done))
+
+def tenants_command(update: Update, context: CallbackContext):
+    if not is_superadmin(update.effective_user.id):
+        update.message.reply_text("⛔ Команда доступна только главному администратору.")
+        return
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT t.tenant_id, t.name, COUNT(a.user_id)
+                    FROM tenants t
+                    LEFT JOIN allowed_users a ON a.tenant_id = t.tenant_id
+                    GROUP BY t.tenant_id, t.name
+                    ORDER BY t.tenant_id
+                """)
+                rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Error listing tenants: {e}")
+        update.message.reply_text("❌ Ошибка при получении списка цехов.")
+        return
+
+    lines = ["🏭 Цеха:"]
+    for tenant_id, name, users_count in rows:
+        lines.append(f"- {tenant_id}: {name} (пользователей: {users_count})")
+    update.message.reply_text("\n".join(lines))
+
+def tenant_add_command(update: Update, context: CallbackContext):
+    if not is_superadmin(update.effective_user.id):
+        update.message.reply_text("⛔ Команда доступна только главному администратору.")
+        return
+
+    name = " ".join(context.args or []).strip()
+    if not name:
+        update.message.reply_text("Использование: /tenant_add <название цеха>")
+        return
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("INSERT INTO tenants (name) VALUES (%s) RETURNING tenant_id", (name,))
+                tenant_id = cursor.fetchone()[0]
+                cursor.execute(SEED_WORK_TYPES_SQL, {'tenant_id': tenant_id, 'names': WORK_TYPES})
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Error creating tenant: {e}")
+        update.message.reply_text("❌ Ошибка при создании цеха.")
+        return
+
+    update.message.reply_text(
+        f"✅ Цех '{name}' создан (id {tenant_id}).\n"
+        f"Добавьте пользователей: /tenant_assign <user_id> {tenant_id} [admin]"
+    )
+
+def tenant_assign_command(update: Update, context: CallbackContext):
+    if not is_superadmin(update.effective_user.id):
+        update.message.reply_text("⛔ Команда доступна только главному администратору.")
+        return
+
+    args = context.args or []
+    try:
+        user_id = int(args[0])
+        tenant_id = int(args[1])
+        make_admin = len(args) > 2 and args[2] == 'admin'
+    except (IndexError, ValueError):
+        update.message.reply_text("Использование: /tenant_assign <user_id> <tenant_id> [admin]")
+        return
+
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM tenants WHERE tenant_id = %s", (tenant_id,))
+                if cursor.fetchone() is None:
+                    update.message.reply_text(f"❌ Цех {tenant_id} не найден.")
+                    return
+                cursor.execute("""
+                    INSERT INTO allowed_users (user_id, tenant_id) VALUES (%s, %s)
+                    ON CONFLICT (user_id) DO UPDATE SET tenant_id = EXCLUDED.tenant_id
+                """, (user_id, tenant_id))
+                cursor.execute("""
+                    INSERT INTO users (user_id, tenant_id, is_admin) VALUES (%s, %s, %s)
+                    ON CONFLICT (user_id) DO UPDATE SET tenant_id = EXCLUDED.tenant_id, is_admin = EXCLUDED.is_admin
+                """, (user_id, tenant_id, make_admin))
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Error assigning user to tenant: {e}")
+        update.message.reply_text("❌ Ошибка при назначении пользователя в цех.")
+        return
+
+    _user_tenants[user_id] = tenant_id
+    _known_allowed[user_id] = True
+    _known_admins[user_id] = make_admin
+    role = "администратор" if make_admin else "работник"
+    update.message.reply_text(f"✅ Пользователь {user_id} назначен в цех {tenant_id} ({role}).")
+
+def work_types_command(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    work_types = get_work_types(get_user_tenant(user_id))
+    if not work_types:
+        update.message.reply_text("Каталог видов работ пуст. Добавьте вид работ: /work_type_add <название>")
+        return
+    lines = ["🛠 Виды работ цеха:"] + [f"- {name}" for _, name in work_types]
+    update.message.reply_text("\n".join(lines))
+
+def work_type_add_command(update: Update, context: CallbackContext):
+    user_id = update.effective_user.id
+    if not is_admin(user_id):
+        update.message.reply_text("⛔ У вас нет прав администратора.")
+        return
+
+    name = " ".join(context.args or []).strip()
+    if not name:
+        update.message.reply_text("Использование: /work_type_add <название>")
+        return
+
+    tenant_id = get_user_tenant(user_id)
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO work_types (tenant_id, name, position)
+                    SELECT %(tenant_id)s, %(name)s, COALESCE(MAX(position), 0) + 1
+                    FROM work_types WHERE tenant_id = %(tenant_id)s
+                    ON CONFLICT (tenant_id, name) DO NOTHING
+                    RETURNING work_type_id
+                """, {'tenant_id': tenant_id, 'name': name})
+                created = cursor.fetchone() is not None
+                conn.commit()
+    except Exception as e:
+        logger.error(f"Error adding work type: {e}")
+        update.message.reply_text("❌ Ошибка при добавлении вида работ.")
+        return
+
+    _work_types_cache.pop(tenant_id, None)
+    if created:
+        update.message.reply_text(f"✅ Вид работ '{name}' добавлен.")
+    else:
+        update.message.reply_text(f"Вид работ '{name}' уже есть в каталоге.")
+
+def is_user_allowed(user_id: int) -> bool:
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT tenant_id FROM allowed_users WHERE user_id = %s", 
+                    (user_id,)
+                )
+                result = cursor.fetchone()
+                if result:
+                    _user_tenants[user_id] = result[0]
+                _known_allowed[user_id] = result is not None
+                return _known_allowed[user_id]
+    except Exception as e:
+        logger.error(f"Error checking allowed user: {e}")
+        return _known_allowed.get(user_id, False)
+
+def unknown_message(update: Update, context: CallbackContext) -> int:
+    if update.message:
+        update.message.reply_text(
+            "Я не понимаю эту команду. Используйте кнопки меню.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
+        )
+    elif update.callback_query:
+        try:
+            update.callback_query.answer()
+            update.callback_query.edit_message_text(
+                text="Я не понимаю эту команду. Используйте кнопки меню.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
+            )
+        except Exception as e:
+            logger.error(f"Error in unknown_message (callback): {e}")
+            if update.callback_query.message:
+                context.bot.send_message(
+                    chat_id=update.callback_query.message.chat_id,
+                    text="Я не понимаю эту команду. Используйте кнопки меню.",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
+                )
+    return MAIN_MENU
+
+def error_handler(update: Update, context: CallbackContext):
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
     
+    if isinstance(context.error, TenantUnknownError):
+        text = "⚠️ Не удалось определить ваш цех. Попробуйте позже или обратитесь к администратору."
+    else:
+        text = "⚠️ Произошла ошибка. Пожалуйста, попробуйте позже."
     try:
         if update.callback_query:
             try:
@@ -754,41 +2160,161 @@ def error_handler(update: Update, context: CallbackContext):
                 pass
             try:
                 update.callback_query.edit_message_text(
-                    text="⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]])
+                    text=text,
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
                 )
             except:
                 if update.callback_query.message:
                     context.bot.send_message(
                         chat_id=update.callback_query.message.chat_id,
-                        text="⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]])
+                        text=text,
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
                     )
         else:
             update.message.reply_text(
-                "⚠️ Произошла ошибка. Пожалуйста, попробуйте позже.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data='main_menu')]])
+                text,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Главное меню", callback_data=cb(CB_MAIN_MENU))]])
             )
     except Exception as e:
         logger.error(f"Error in error_handler: {e}")
     
     return MAIN_MENU
 
-def main() -> None:
-    try:
-        init_db()
-    except Exception as e:
-        logger.error(f"Ошибка при инициализации БД: {e}")
+# Корректная остановка
+DRAIN_TIMEOUT = 30
+# Обновления, не обработанные за DRAIN_TIMEOUT: Telegram их уже не отдаст, поэтому храним в bot_data
+PENDING_UPDATES_KEY = 'pending_updates'
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_state.pickle')
+# Диалог без активности дольше CONVERSATION_TIMEOUT секунд завершается, чтобы сохраненное состояние не осталось навсегда
+CONVERSATION_TIMEOUT = 30 * 60
+UPDATE_TRACKING_GROUP = 100
+# Обновления, обработанные раньше меньших update_id: после перезапуска Telegram может прислать их снова
+PROCESSED_UPDATES_KEY = 'processed_update_ids'
+UPDATE_DEDUP_GROUP = -4
+
+_processed_before_restart: set = set()
+
+# Запись входящих обновлений для replay.py, включается переменной RECORD_UPDATES_FILE
+RECORD_UPDATES_FILE = os.getenv('RECORD_UPDATES_FILE')
+RECORD_SALT = os.getenv('RECORD_SALT', '')
+UPDATE_RECORDING_GROUP = -3
+
+update_recorder = None
+
+def record_update(update: Update, context: CallbackContext):
+    if update_recorder:
+        try:
+            update_recorder.record(update.to_dict())
+        except Exception as e:
+            logger.error(f"Error recording update: {e}")
+
+def skip_processed_update(update: Update, context: CallbackContext):
+    if update.update_id in _processed_before_restart:
+        logger.info(f"Skipping update {update.update_id} processed before restart")
+        track_processed_update(update, context)
+        raise DispatcherHandlerStop()
+
+def track_processed_update(update: Update, context: CallbackContext):
+    update_queue = context.dispatcher.update_queue
+    if not isinstance(update_queue, FairUpdateQueue):
+        # Обновления обрабатываются по порядку: последний обработанный и есть граница
+        context.bot_data['last_update_id'] = update.update_id
         return
 
-    token = os.getenv('TELEGRAM_TOKEN')
-    if not token:
-        logger.error("Не задан TELEGRAM_TOKEN")
+    # Очередь чередует цеха, поэтому продолжаем с границы, ниже которой обработано все
+    update_queue.mark_processed(update.update_id)
+    watermark = update_queue.watermark()
+    if watermark is None:
         return
-        
-    updater = Updater(token, use_context=True)
+    context.bot_data['last_update_id'] = max(watermark, context.bot_data.get('last_update_id') or 0)
+    context.bot_data[PROCESSED_UPDATES_KEY] = update_queue.processed_above_watermark() | {
+        update_id for update_id in _processed_before_restart if update_id > watermark
+    }
+
+def expire_restored_conversations(context: CallbackContext):
+    # Таймеры conversation_timeout не сохраняются: диалоги, восстановленные после перезапуска
+    # и с тех пор не продолженные, завершаем сами
+    for handler, keys in context.job.context:
+        for key in keys:
+            if key in handler.conversations and key not in handler.timeout_jobs:
+                del handler.conversations[key]
+                handler.persistence.update_conversation(handler.name, key, None)
+
+def schedule_restored_conversations_expiry(dispatcher):
+    restored = [
+        (handler, set(handler.conversations))
+        for handlers in dispatcher.handlers.values()
+        for handler in handlers
+        if isinstance(handler, ConversationHandler) and handler.persistent and handler.conversations
+    ]
+    if restored:
+        dispatcher.job_queue.run_once(expire_restored_conversations, CONVERSATION_TIMEOUT, context=restored)
+        logger.info(f"Restored conversations: {sum(len(keys) for _, keys in restored)}")
+
+def wait_for_stop_signal():
+    stop_event = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda signum, frame: stop_event.set())
+    while not stop_event.is_set():
+        stop_event.wait(1)
+
+def drain_dispatcher(dispatcher, timeout: float) -> bool:
+    update_queue = dispatcher.update_queue
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not update_queue.unfinished_tasks:
+            return True
+        time.sleep(0.1)
+
+    # Telegram подтвердил получение этих обновлений, поэтому сохраняем их до следующего запуска
+    pending = dispatcher.bot_data.setdefault(PENDING_UPDATES_KEY, [])
+    while True:
+        try:
+            update = update_queue.get_nowait()
+        except Exception:
+            break
+        if isinstance(update, Update):
+            pending.append(update.to_dict())
+        update_queue.task_done()
+    logger.warning(f"Dispatcher drain timed out after {timeout} s, saved {len(pending)} queued updates")
+    return False
+
+def restore_pending_updates(dispatcher):
+    pending = dispatcher.bot_data.pop(PENDING_UPDATES_KEY, None)
+    if not pending:
+        return
+    for data in pending:
+        try:
+            dispatcher.update_queue.put(Update.de_json(data, dispatcher.bot))
+        except Exception as e:
+            logger.error(f"Error restoring saved update: {e}")
+    logger.info(f"Restored {len(pending)} updates saved at the last shutdown")
+
+def shutdown(updater: Updater):
+    logger.info("Остановка бота...")
+    # Прекращаем прием: полученные после этого обновления Telegram отдаст при следующем запуске
+    updater.running = False
+    drain_dispatcher(updater.dispatcher, DRAIN_TIMEOUT)
+    updater.stop()
+
+    flush_user_profiles()
+    replay_queued_reports()
+    shutdown_executor()
+    if update_recorder:
+        update_recorder.close()
+
     dispatcher = updater.dispatcher
+    if dispatcher.persistence:
+        try:
+            dispatcher.update_persistence()
+            dispatcher.persistence.flush()
+        except Exception as e:
+            logger.error(f"Error flushing persistence: {e}")
+
+    close_db_pool()
+    logger.info("Бот остановлен")
 
+def setup_handlers(dispatcher) -> None:
     # Определение состояний ConversationHandler
     (
         MAIN_MENU,
@@ -801,74 +2327,142 @@ def main() -> None:
         REPORT_AMOUNT,
         MANAGE_USERS,
         ADD_USER,
-        REMOVE_USER
-    ) = range(11)
+        REMOVE_USER,
+        EDIT_REPORT_AMOUNT
+    ) = range(12)
+
+    # Пропуск повторов, запись обновлений, отслеживание профилей пользователей и обработанных обновлений
+    dispatcher.add_handler(TypeHandler(Update, skip_processed_update), group=UPDATE_DEDUP_GROUP)
+    dispatcher.add_handler(TypeHandler(Update, record_update), group=UPDATE_RECORDING_GROUP)
+    dispatcher.add_handler(TypeHandler(Update, track_user_profile), group=-1)
+    dispatcher.add_handler(TypeHandler(Update, track_processed_update), group=UPDATE_TRACKING_GROUP)
 
     # Основные обработчики
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("cancel", cancel))
+    dispatcher.add_handler(CommandHandler("activity", activity))
+    dispatcher.add_handler(CommandHandler("chart", chart))
+    dispatcher.add_handler(CommandHandler("health", health))
+    dispatcher.add_handler(CommandHandler("clone_task", clone_task_command))
+    dispatcher.add_handler(CommandHandler("tenants", tenants_command))
+    dispatcher.add_handler(CommandHandler("tenant_add", tenant_add_command))
+    dispatcher.add_handler(CommandHandler("tenant_assign", tenant_assign_command))
+    dispatcher.add_handler(CommandHandler("work_types", work_types_command))
+    dispatcher.add_handler(CommandHandler("work_type_add", work_type_add_command))
 
-    # Обработчики callback-запросов
-    dispatcher.add_handler(CallbackQueryHandler(show_main_menu, pattern='^main_menu$'))
-    dispatcher.add_handler(CallbackQueryHandler(admin_panel, pattern='^admin_panel$'))
-    dispatcher.add_handler(CallbackQueryHandler(view_tasks, pattern='^view_tasks$'))
-    dispatcher.add_handler(CallbackQueryHandler(view_reports, pattern='^view_reports$'))
-    dispatcher.add_handler(CallbackQueryHandler(send_report, pattern='^send_report$'))
-    dispatcher.add_handler(CallbackQueryHandler(set_task, pattern='^set_task$'))
+    # Callback-запросы маршрутизируются по действию из callback_data одним поиском в словаре.
+    # Диалоги регистрируются первыми, чтобы их точки входа не перехватывал общий маршрутизатор.
+    # Завершающие шаги, главное меню и админ-панель возвращают END: состояний MAIN_MENU и ADMIN_PANEL в диалогах нет.
 
     # ConversationHandler для создания задач
     task_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(set_task, pattern='^set_task$')],
+        entry_points=[CallbackRouter({CB_SET_TASK: set_task}, LEGACY_CALLBACKS)],
         states={
             SET_TASK_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, set_task_amount)],
-            ADD_WORK_TYPE: [
-                CallbackQueryHandler(select_work_type, pattern='^add_work_[0-9]+$'),
-                CallbackQueryHandler(finish_adding_works, pattern='^finish_adding_works$')
+            ADD_WORK_TYPE: [CallbackRouter({
+                CB_ADD_WORK: select_work_type,
+                CB_LEGACY_ADD_WORK: select_legacy_work_type,
+                CB_FINISH_ADDING_WORKS: finish_adding_works,
+                CB_ADD_WORK_TYPE: add_work_type,
+            }, LEGACY_CALLBACKS)],
+            SET_WORK_AMOUNT: [
+                MessageHandler(Filters.text & ~Filters.command, set_work_amount),
+                CallbackRouter({CB_ADD_WORK_TYPE: add_work_type}, LEGACY_CALLBACKS)
             ],
-            SET_WORK_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, set_work_amount)],
-            CONFIRM_TASK: [CallbackQueryHandler(confirm_task, pattern='^confirm_task$')]
+            CONFIRM_TASK: [CallbackRouter({
+                CB_CONFIRM_TASK: confirm_task,
+                CB_ADD_WORK_TYPE: add_work_type,
+            }, LEGACY_CALLBACKS)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
-            CallbackQueryHandler(admin_panel, pattern='^admin_panel$')
+            CallbackRouter({CB_ADMIN_PANEL: admin_panel}, LEGACY_CALLBACKS)
         ],
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name='task_conversation',
+        persistent=True
     )
     dispatcher.add_handler(task_conv_handler)
 
     # ConversationHandler для отправки отчетов
     report_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(send_report, pattern='^send_report$')],
+        entry_points=[CallbackRouter({CB_SEND_REPORT: send_report}, LEGACY_CALLBACKS)],
         states={
-            REPORT_WORK_TYPE: [CallbackQueryHandler(report_work_type, pattern='^report_work_[0-9]+$')],
-            REPORT_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, save_report)]
+            REPORT_WORK_TYPE: [CallbackRouter({
+                CB_REPORT_WORK: report_work_type,
+                CB_LEGACY_REPORT_WORK: report_legacy_work_type,
+                CB_REPORT_TASK: select_task_for_report,
+                CB_REPORT_WITHOUT_TASK: select_task_for_report,
+                CB_SEND_REPORT: send_report,
+            }, LEGACY_CALLBACKS)],
+            REPORT_AMOUNT: [
+                MessageHandler(Filters.text & ~Filters.command, save_report),
+                CallbackRouter({CB_SEND_REPORT: send_report}, LEGACY_CALLBACKS)
+            ]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
-            CallbackQueryHandler(show_main_menu, pattern='^main_menu$')
+            CallbackRouter({CB_MAIN_MENU: show_main_menu}, LEGACY_CALLBACKS)
         ],
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name='report_conversation',
+        persistent=True
     )
     dispatcher.add_handler(report_conv_handler)
 
+    # ConversationHandler для изменения последнего отчета
+    edit_report_conv_handler = ConversationHandler(
+        entry_points=[CallbackRouter({CB_EDIT_LAST_REPORT: edit_last_report}, LEGACY_CALLBACKS)],
+        states={
+            EDIT_REPORT_AMOUNT: [MessageHandler(Filters.text & ~Filters.command, save_edited_report)]
+        },
+        fallbacks=[
+            CommandHandler('cancel', cancel),
+            CallbackRouter({CB_MY_REPORTS: cancel_edit_report}, LEGACY_CALLBACKS)
+        ],
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name='edit_report_conversation',
+        persistent=True
+    )
+    dispatcher.add_handler(edit_report_conv_handler)
+
     # ConversationHandler для управления пользователями
     user_management_conv_handler = ConversationHandler(
-        entry_points=[
-            CallbackQueryHandler(add_user, pattern='^add_user$'),
-            CallbackQueryHandler(remove_user, pattern='^remove_user$')
-        ],
+        entry_points=[CallbackRouter({
+            CB_ADD_USER: add_user,
+            CB_REMOVE_USER: remove_user,
+        }, LEGACY_CALLBACKS)],
         states={
             ADD_USER: [MessageHandler(Filters.text & ~Filters.command, add_user_handler)],
             REMOVE_USER: [MessageHandler(Filters.text & ~Filters.command, remove_user_handler)]
         },
         fallbacks=[
             CommandHandler('cancel', cancel),
-            CallbackQueryHandler(manage_users, pattern='^manage_users$')
+            CallbackRouter({CB_MANAGE_USERS: manage_users}, LEGACY_CALLBACKS)
         ],
-        per_message=False
+        per_message=False,
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name='user_management_conversation',
+        persistent=True
     )
     dispatcher.add_handler(user_management_conv_handler)
 
+    # Общие callback-запросы вне диалогов
+    dispatcher.add_handler(CallbackRouter({
+        CB_MAIN_MENU: show_main_menu,
+        CB_ADMIN_PANEL: admin_panel,
+        CB_VIEW_TASKS: view_tasks,
+        CB_VIEW_REPORTS: view_reports,
+        CB_SEND_REPORT: send_report,
+        CB_SET_TASK: set_task,
+        CB_MY_REPORTS: my_reports,
+        CB_DELETE_LAST_REPORT: delete_last_report,
+        CB_MANAGE_USERS: manage_users,
+    }, LEGACY_CALLBACKS))
+
     # Обработчик неизвестных сообщений
     dispatcher.add_handler(MessageHandler(
         Filters.text & ~Filters.command,
@@ -878,13 +2472,77 @@ def main() -> None:
     # Обработчик ошибок
     dispatcher.add_error_handler(error_handler)
 
+DISPATCHER_WORKERS = 4
+
+def update_tenant_key(update) -> Optional[int]:
+    # Пользователи, чей цех еще не определен, делят общую очередь
+    if isinstance(update, Update) and update.effective_user:
+        return _user_tenants.get(update.effective_user.id)
+    return None
+
+def main() -> None:
+    global update_recorder
+
+    try:
+        init_db()
+    except Exception as e:
+        logger.error(f"Ошибка при инициализации БД: {e}")
+        return
+
+    token = os.getenv('TELEGRAM_TOKEN')
+    if not token:
+        logger.error("Не задан TELEGRAM_TOKEN")
+        return
+        
+    persistence = PicklePersistence(filename=PERSISTENCE_FILE, on_flush=True)
+    # Собственный диспетчер нужен ради очереди, которая чередует обновления разных цехов
+    job_queue = JobQueue()
+    dispatcher = Dispatcher(
+        ExtBot(token, request=Request(con_pool_size=DISPATCHER_WORKERS + 4)),
+        FairUpdateQueue(update_tenant_key),
+        workers=DISPATCHER_WORKERS,
+        job_queue=job_queue,
+        persistence=persistence,
+        use_context=True
+    )
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(workers=None, dispatcher=dispatcher)
+
+    if RECORD_UPDATES_FILE:
+        if not RECORD_SALT:
+            logger.warning("RECORD_SALT не задан: псевдонимы пользователей будут предсказуемы")
+        update_recorder = UpdateRecorder(RECORD_UPDATES_FILE, RECORD_SALT)
+        logger.info(f"Обновления записываются в {RECORD_UPDATES_FILE}")
+    # Цех пользователей переживает перезапуск: без него в деградированном режиме их действия отклонялись бы.
+    # Карта строится заново из allowed_users, сохраненная нужна, только если БД недоступна
+    try:
+        load_user_tenants()
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить цеха пользователей, используется сохраненная карта: {e}")
+        _user_tenants.update(dispatcher.bot_data.get(USER_TENANTS_KEY, {}))
+    dispatcher.bot_data[USER_TENANTS_KEY] = _user_tenants
+    setup_handlers(dispatcher)
+    schedule_restored_conversations_expiry(dispatcher)
+
+    # Периодические задачи
+    updater.job_queue.run_repeating(flush_user_profiles, interval=PROFILE_FLUSH_INTERVAL, first=PROFILE_FLUSH_INTERVAL)
+    updater.job_queue.run_repeating(replay_queued_reports, interval=REPORT_REPLAY_INTERVAL, first=0)
+    updater.job_queue.run_repeating(log_health, interval=300, first=300)
+
     # Запуск бота
     try:
-        updater.start_polling(drop_pending_updates=True)
+        last_update_id = dispatcher.bot_data.get('last_update_id')
+        if last_update_id:
+            updater.last_update_id = last_update_id + 1
+        _processed_before_restart.update(dispatcher.bot_data.get(PROCESSED_UPDATES_KEY, ()))
+        restore_pending_updates(dispatcher)
+        updater.start_polling(drop_pending_updates=False)
         logger.info("Бот успешно запущен")
-        updater.idle()
+        wait_for_stop_signal()
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
+    finally:
+        shutdown(updater)
 
 if __name__ == '__main__':
     main()
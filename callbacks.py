@@ -0,0 +1,86 @@
+from functools import lru_cache
+from typing import Callable, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Handler
+
+# Компактный протокол callback_data: "<версия>:<действие>[:<аргумент>...]", не длиннее 64 байт
+
+CALLBACK_VERSION = '1'
+SEPARATOR = ':'
+MAX_CALLBACK_DATA = 64
+
+Route = Tuple[str, Tuple[str, ...]]
+
+
+class CallbackDataError(ValueError):
+    pass
+
+
+def encode_callback(action: str, *args) -> str:
+    parts = [CALLBACK_VERSION, action, *map(str, args)]
+    if any(SEPARATOR in part for part in parts[1:]):
+        raise CallbackDataError(f"Separator in callback part: {parts}")
+    data = SEPARATOR.join(parts)
+    if len(data.encode('utf-8')) > MAX_CALLBACK_DATA:
+        raise CallbackDataError(f"Callback data longer than {MAX_CALLBACK_DATA} bytes: {data}")
+    return data
+
+
+@lru_cache(maxsize=4096)
+def decode_callback(data: str) -> Optional[Route]:
+    version, _, rest = data.partition(SEPARATOR)
+    if version != CALLBACK_VERSION or not rest:
+        return None
+    action, *args = rest.split(SEPARATOR)
+    return action, tuple(args)
+
+
+@lru_cache(maxsize=1024)
+def _decode_legacy(data: str, legacy: Tuple[Tuple[str, str], ...]) -> Optional[Route]:
+    # Кнопки в старых сообщениях: "main_menu", "add_work_3" и т.п.
+    actions = dict(legacy)
+    if data in actions:
+        return actions[data], ()
+    prefix, _, arg = data.rpartition('_')
+    if arg.isdigit() and prefix in actions:
+        return actions[prefix], (arg,)
+    return None
+
+
+class CallbackRouter(Handler):
+    """Обработчик callback-запросов, выбирающий функцию по действию одним поиском в словаре.
+
+    Аргументы из callback_data передаются в функцию через context.args.
+    """
+
+    def __init__(self, routes: Dict[str, Callable], legacy: Optional[Dict[str, str]] = None,
+                 run_async: bool = False):
+        super().__init__(self._dispatch, run_async=run_async)
+        self.routes = dict(routes)
+        self.legacy = tuple(sorted(legacy.items())) if legacy else ()
+
+    def _route(self, data: str) -> Optional[Route]:
+        route = decode_callback(data)
+        if route is None and self.legacy:
+            route = _decode_legacy(data, self.legacy)
+        return route
+
+    def _dispatch(self, update: Update, context):
+        # Разбор закэширован, повторный вызов для уже проверенного запроса почти бесплатен
+        action, _ = self._route(update.callback_query.data)
+        return self.routes[action](update, context)
+
+    def check_update(self, update: object) -> Optional[Route]:
+        if not isinstance(update, Update) or not update.callback_query:
+            return None
+        data = update.callback_query.data
+        if not data:
+            return None
+        route = self._route(data)
+        if route is None or route[0] not in self.routes:
+            return None
+        return route
+
+    def collect_additional_context(self, context, update, dispatcher, check_result: Route):
+        context.args = list(check_result[1])
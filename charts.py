@@ -0,0 +1,117 @@
+import io
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import date
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+# Рендеринг графиков в отдельных процессах, чтобы не блокировать потоки диспетчера
+
+CHART_CACHE_TTL = 60 * 60
+CHART_CACHE_SIZE = 64
+CHART_WORKERS = 2
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def render_daily_chart(title: str, days: List[date], series: Dict[str, List[int]]) -> bytes:
+    """Строит линейный график по дням и возвращает PNG. Выполняется в дочернем процессе."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.dates as mdates
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 5), dpi=100)
+    try:
+        for label, values in series.items():
+            ax.plot(days, values, marker='o', markersize=3, label=label)
+        ax.set_title(title)
+        ax.set_ylabel("Количество")
+        ax.grid(True, alpha=0.3)
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d.%m'))
+        if series:
+            ax.legend(loc='upper left', fontsize='small')
+        fig.autofmt_xdate()
+        fig.tight_layout()
+
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        return buffer.getvalue()
+    finally:
+        plt.close(fig)
+
+
+class ChartCache:
+    """LRU-кэш готовых PNG по ключу (запрос, версия данных) с ограничением по времени."""
+
+    def __init__(self, ttl: float = CHART_CACHE_TTL, max_size: int = CHART_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            image, created_at = item
+            if time.monotonic() - created_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return image
+
+    def put(self, key: Hashable, image: bytes):
+        with self._lock:
+            self._items[key] = (image, time.monotonic())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+chart_cache = ChartCache()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: fork из многопоточного процесса с открытыми сокетами БД небезопасен
+            _executor = ProcessPoolExecutor(
+                max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+ChartData = Tuple[str, List[date], Dict[str, List[int]]]
+
+
+def submit_chart(key: Hashable, build: Callable[[], ChartData]) -> Future:
+    """Возвращает Future с PNG: из кэша сразу, иначе данные готовит build(), а рисует пул процессов."""
+    cached = chart_cache.get(key)
+    if cached is not None:
+        future = Future()
+        future.set_result(cached)
+        return future
+
+    title, days, series = build()
+    future = get_executor().submit(render_daily_chart, title, days, series)
+
+    def store(done: Future):
+        if not done.cancelled() and done.exception() is None:
+            chart_cache.put(key, done.result())
+
+    future.add_done_callback(store)
+    return future
+
+
+def shutdown_executor(wait: bool = True):
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
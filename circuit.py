@@ -0,0 +1,93 @@
+import logging
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+# Автоматический выключатель: после серии ошибок перестает обращаться к ресурсу на reset_timeout секунд
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен без обращения к ресурсу, так как выключатель разомкнут."""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 15.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def _set_state(self, state: str):
+        if state != self._state:
+            logger.warning(f"Circuit '{self.name}': {self._state} -> {state}")
+            self._state = state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def before_call(self):
+        """Бросает CircuitOpenError, если вызов сейчас выполнять нельзя."""
+        with self._lock:
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.total_rejected += 1
+                    raise CircuitOpenError(f"Circuit '{self.name}' is open")
+                self._set_state(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN:
+                # В полуоткрытом состоянии пропускаем только один пробный вызов
+                if self._probe_in_flight:
+                    self.total_rejected += 1
+                    raise CircuitOpenError(f"Circuit '{self.name}' is half-open")
+                self._probe_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self.total_failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """Завершает вызов, не давший информации о состоянии ресурса."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def stats(self) -> Dict[str, object]:
+        state = self.state
+        with self._lock:
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'total_failures': self.total_failures,
+                'total_rejected': self.total_rejected,
+            }
@@ -0,0 +1,93 @@
+"""TCP-прокси перед локальным Postgres, добавляющий задержки и обрывы соединений.
+
+Позволяет проверить автоматический выключатель и деградированный режим бота:
+
+    python fault_proxy.py --target-port 5432 --listen-port 6432 --latency 2 --failure-rate 0.3
+    DB_HOST=127.0.0.1 DB_PORT=6432 DB_SSLMODE=disable python bot.py
+
+Параметры можно менять на лету, отправляя в stdin строки вида "latency 0" или "failure_rate 1".
+"""
+import argparse
+import asyncio
+import logging
+import random
+import sys
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger('fault_proxy')
+
+
+class Faults:
+    def __init__(self, latency: float, failure_rate: float):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+
+async def pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, faults: Faults):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            if faults.latency:
+                await asyncio.sleep(faults.latency)
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_client(client_reader, client_writer, args, faults: Faults):
+    if random.random() < faults.failure_rate:
+        logger.info("Dropping connection")
+        client_writer.close()
+        return
+    try:
+        server_reader, server_writer = await asyncio.open_connection(args.target_host, args.target_port)
+    except OSError as e:
+        logger.error(f"Cannot reach target: {e}")
+        client_writer.close()
+        return
+    await asyncio.gather(
+        pipe(client_reader, server_writer, faults),
+        pipe(server_reader, client_writer, faults),
+    )
+
+
+async def read_commands(faults: Faults):
+    loop = asyncio.get_running_loop()
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            return
+        try:
+            name, value = line.split()
+            setattr(faults, name, float(value))
+            logger.info(f"{name} = {value}")
+        except (ValueError, AttributeError):
+            logger.warning("Expected '<latency|failure_rate> <value>'")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--listen-host', default='127.0.0.1')
+    parser.add_argument('--listen-port', type=int, default=6432)
+    parser.add_argument('--target-host', default='127.0.0.1')
+    parser.add_argument('--target-port', type=int, default=5432)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка на каждый пакет, секунды")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="доля сбрасываемых соединений, 0..1")
+    args = parser.parse_args()
+
+    faults = Faults(args.latency, args.failure_rate)
+    server = await asyncio.start_server(
+        lambda r, w: handle_client(r, w, args, faults), args.listen_host, args.listen_port
+    )
+    logger.info(f"Proxying {args.listen_host}:{args.listen_port} -> {args.target_host}:{args.target_port}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), read_commands(faults))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,98 @@
+import gzip
+import hashlib
+import hmac
+import json
+import threading
+import time
+from typing import Iterator, Tuple
+
+# Запись входящих обновлений в файл JSON Lines для последующего воспроизведения (replay.py).
+# Идентификаторы пользователей и чатов заменяются стабильными псевдонимами, имена удаляются.
+
+ANONYMIZED_OBJECTS = ('from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat')
+PERSONAL_FIELDS = ('username', 'first_name', 'last_name', 'title', 'phone_number', 'language_code')
+# Обязательные поля, которые нельзя отбрасывать даже с пустым значением
+REQUIRED_FIELDS = ('is_bot',)
+
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class UpdateAnonymizer:
+    def __init__(self, salt: str):
+        self._key = salt.encode('utf-8')
+
+    def pseudonym(self, value: int) -> int:
+        digest = hmac.new(self._key, str(abs(value)).encode('ascii'), hashlib.sha256).hexdigest()
+        # Сохраняем знак: отрицательные id у групп и каналов
+        alias = int(digest[:12], 16) % 10 ** 12 + 1
+        return -alias if value < 0 else alias
+
+    def anonymize(self, data):
+        if isinstance(data, list):
+            return [self.anonymize(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        for key, value in data.items():
+            # Пустые значения по умолчанию только раздувают запись. Сравнение по идентичности:
+            # 0 == False, а нулевые поля (например, offset у сущности /команды) обязательны
+            if (value is None or value is False or value in ([], {})) and key not in REQUIRED_FIELDS:
+                continue
+            if key in ANONYMIZED_OBJECTS and isinstance(value, dict):
+                value = self._anonymize_entity(value)
+            result[key] = self.anonymize(value)
+        return result
+
+    def _anonymize_entity(self, entity: dict) -> dict:
+        entity = {k: v for k, v in entity.items() if k not in PERSONAL_FIELDS}
+        if isinstance(entity.get('id'), int):
+            entity['id'] = self.pseudonym(entity['id'])
+        if 'is_bot' in entity:
+            # first_name обязателен для User
+            entity['first_name'] = f"user{entity.get('id')}"
+        return entity
+
+
+class UpdateRecorder:
+    """Построчно пишет обновления: {"t": время получения, "u": обновление}."""
+
+    def __init__(self, path: str, salt: str, flush_every: int = 50):
+        self.path = path
+        self.anonymizer = UpdateAnonymizer(salt)
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._file = _open(path, 'a')
+        self._unflushed = 0
+
+    def record(self, update_dict: dict):
+        line = json.dumps(
+            {'t': round(time.time(), 3), 'u': self.anonymizer.anonymize(update_dict)},
+            ensure_ascii=False,
+            separators=(',', ':')
+        )
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(line + '\n')
+            self._unflushed += 1
+            if self._unflushed >= self.flush_every:
+                self._file.flush()
+                self._unflushed = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path: str) -> Iterator[Tuple[float, dict]]:
+    with _open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                yield item['t'], item['u']
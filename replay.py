@@ -0,0 +1,271 @@
+"""Воспроизведение записанных обновлений через все обработчики bot.py.
+
+Запись включается в работающем боте переменными окружения:
+
+    RECORD_UPDATES_FILE=traffic.updates.jsonl.gz RECORD_SALT=<секрет> python bot.py
+
+Воспроизведение против заглушки Bot API и локальной БД (переменные DB_* как у бота):
+
+    DB_HOST=127.0.0.1 DB_SSLMODE=disable python replay.py traffic.updates.jsonl.gz \\
+        --speed 10 --seed-users --report new.json --baseline old.json
+
+--speed 1 сохраняет исходные интервалы, 0 подает обновления без пауз.
+Отчет в JSON содержит время обработки по видам обновлений, его можно сравнивать между версиями.
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from typing import Dict, List
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, DictPersistence, JobQueue
+
+import bot
+from callbacks import decode_callback
+from charts import shutdown_executor
+from recording import read_recording
+
+logger = logging.getLogger('replay')
+
+STUB_TOKEN = '123456:REPLAYstubTOKENreplayStubTokenReplay00'
+# Обработчики сами ловят свои исключения и отвечают текстом ошибки: считаем такие ответы
+ERROR_REPLY_PREFIXES = ('❌', '⚠️')
+
+
+class StubBotAPI(BaseHTTPRequestHandler):
+    """Отвечает на любые методы Bot API правдоподобным успешным результатом."""
+
+    latency = 0.0
+    calls: Dict[str, int] = defaultdict(int)
+    calls_lock = threading.Lock()
+    message_id = 0
+    error_replies = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if 'application/json' in (self.headers.get('Content-Type') or ''):
+            try:
+                return json.loads(body or b'{}')
+            except ValueError:
+                return {}
+        return {}
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        params = self._params()
+        with StubBotAPI.calls_lock:
+            StubBotAPI.calls[method] += 1
+            StubBotAPI.message_id += 1
+            message_id = StubBotAPI.message_id
+            if str(params.get('text', '')).startswith(ERROR_REPLY_PREFIXES):
+                StubBotAPI.error_replies += 1
+        if StubBotAPI.latency:
+            time.sleep(StubBotAPI.latency)
+
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'replay', 'username': 'replay_bot'}
+        elif method.startswith(('send', 'edit')):
+            result = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+
+        body = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+
+def update_kind(update: Update) -> str:
+    if update.callback_query and update.callback_query.data:
+        data = update.callback_query.data
+        route = decode_callback(data)
+        if route is None:
+            name = data.rstrip('0123456789').rstrip('_')
+            route = (bot.LEGACY_CALLBACKS.get(name, name), ())
+        return f"callback:{route[0]}"
+    message = update.effective_message
+    if message and message.text:
+        if message.text.startswith('/'):
+            return f"command:{message.text.split()[0].split('@')[0]}"
+        return 'message:text'
+    return 'other'
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(timings: Dict[str, List[float]], error_replies: Dict[str, int]) -> Dict[str, dict]:
+    report = {}
+    for kind, values in sorted(timings.items()):
+        values = sorted(values)
+        report[kind] = {
+            'count': len(values),
+            'error_replies': error_replies.get(kind, 0),
+            'total_ms': round(sum(values), 3),
+            'mean_ms': round(sum(values) / len(values), 3),
+            'p50_ms': round(percentile(values, 0.5), 3),
+            'p95_ms': round(percentile(values, 0.95), 3),
+            'p99_ms': round(percentile(values, 0.99), 3),
+            'max_ms': round(values[-1], 3),
+        }
+    return report
+
+
+def recorded_user_ids(records) -> set:
+    user_ids = set()
+    for _, data in records:
+        for key in ('message', 'edited_message', 'callback_query'):
+            sender = (data.get(key) or {}).get('from')
+            if sender:
+                user_ids.add(sender['id'])
+    return user_ids
+
+
+def seed_users(user_ids):
+    with bot.get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            for user_id in user_ids:
+                cursor.execute(
+                    "INSERT INTO users (user_id, full_name) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                    (user_id, f"user{user_id}")
+                )
+                cursor.execute(
+                    "INSERT INTO allowed_users (user_id) VALUES (%s) ON CONFLICT DO NOTHING",
+                    (user_id,)
+                )
+            conn.commit()
+
+
+def print_report(report: dict, baseline: dict = None):
+    header = f"{'kind':<28}{'count':>7}{'errors':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}"
+    if baseline:
+        header += f"{'p95 Δ':>10}"
+    print(header)
+    for kind, stats in report['kinds'].items():
+        line = (f"{kind:<28}{stats['count']:>7}{stats['error_replies']:>8}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}"
+                f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+        if baseline:
+            old = baseline.get('kinds', {}).get(kind)
+            line += f"{stats['p95_ms'] - old['p95_ms']:>+10.2f}" if old else f"{'—':>10}"
+        print(line)
+    print(f"updates: {report['updates']}, errors: {report['errors']}, error replies: {report['error_replies']}, "
+          f"wall time: {report['wall_time_s']:.2f} s, api calls: {sum(report['api_calls'].values())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording')
+    parser.add_argument('--speed', type=float, default=0.0, help="множитель скорости, 0 — без пауз")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка заглушки Bot API, секунды")
+    parser.add_argument('--seed-users', action='store_true', help="добавить пользователей из записи в allowed_users")
+    parser.add_argument('--report', help="куда сохранить отчет в JSON")
+    parser.add_argument('--baseline', help="отчет предыдущей версии для сравнения")
+    args = parser.parse_args()
+
+    StubBotAPI.latency = args.api_latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBotAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/bot'
+
+    replay_bot = Bot(STUB_TOKEN, base_url=base_url)
+    job_queue = JobQueue()
+    # Очередь диспетчера не используется: обновления подаются через process_update.
+    # Поток диспетчера нужен ради пула run_async, через который, например, /chart отправляет фото
+    dispatcher = Dispatcher(replay_bot, Queue(), job_queue=job_queue, persistence=DictPersistence(), use_context=True)
+    job_queue.set_dispatcher(dispatcher)
+    bot.setup_handlers(dispatcher)
+    bot.init_db()
+    dispatcher_ready = threading.Event()
+    threading.Thread(target=dispatcher.start, kwargs={'ready': dispatcher_ready}, daemon=True).start()
+    dispatcher_ready.wait()
+
+    records = list(read_recording(args.recording))
+    if args.seed_users:
+        seed_users(recorded_user_ids(records))
+
+    timings: Dict[str, List[float]] = defaultdict(list)
+    error_replies: Dict[str, int] = defaultdict(int)
+    errors = 0
+
+    def count_error(update, context):
+        nonlocal errors
+        errors += 1
+
+    dispatcher.add_error_handler(count_error)
+
+    started = time.perf_counter()
+    first_t = records[0][0] if records else 0.0
+    for t, data in records:
+        if args.speed > 0:
+            delay = (t - first_t) / args.speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+        try:
+            update = Update.de_json(data, replay_bot)
+        except Exception as e:
+            logger.error(f"Cannot parse recorded update {data.get('update_id')}: {e}")
+            errors += 1
+            continue
+        kind = update_kind(update)
+        replies_before = StubBotAPI.error_replies
+        update_started = time.perf_counter()
+        dispatcher.process_update(update)
+        timings[kind].append((time.perf_counter() - update_started) * 1000)
+        error_replies[kind] += StubBotAPI.error_replies - replies_before
+
+    # Дожидаемся отложенной работы: рендеринга графиков и задач run_async.
+    # Ответы, пришедшие из нее, не привязаны к обновлению и считаются как 'async'
+    replies_before = StubBotAPI.error_replies
+    shutdown_executor()
+    dispatcher.stop()
+    if StubBotAPI.error_replies > replies_before:
+        error_replies['async'] += StubBotAPI.error_replies - replies_before
+    wall_time = time.perf_counter() - started
+
+    bot.flush_user_profiles()
+    server.shutdown()
+    bot.close_db_pool()
+
+    report = {
+        'recording': args.recording,
+        'updates': len(records),
+        'errors': errors,
+        'error_replies': sum(error_replies.values()),
+        'wall_time_s': round(wall_time, 3),
+        'api_calls': dict(StubBotAPI.calls),
+        'kinds': summarize(timings, error_replies),
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import heapq
+import queue
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+# Очередь обновлений для диспетчера с честным чередованием между цехами
+
+
+class FairUpdateQueue(queue.Queue):
+    """Держит отдельную FIFO-очередь на каждый ключ и выдает элементы по кругу.
+
+    Всплеск обновлений от одного цеха не задерживает остальные дольше, чем на одно
+    обновление за круг. Порядок внутри одного ключа сохраняется.
+
+    Обновления разных ключей завершаются не по порядку update_id, поэтому очередь также
+    ведет границу: наибольший update_id, до которого обработаны все полученные обновления.
+    """
+
+    def __init__(self, key_func: Callable[[object], Hashable], maxsize: int = 0):
+        self.key_func = key_func
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queues: 'OrderedDict[Hashable, deque]' = OrderedDict()
+        self._size = 0
+        # update_id полученных, но не отмеченных обработанными обновлений (куча с ленивым удалением)
+        self._unprocessed: List[int] = []
+        self._processed: Set[int] = set()
+        self._max_received: Optional[int] = None
+
+    def _qsize(self):
+        return self._size
+
+    def _put(self, item):
+        try:
+            key = self.key_func(item)
+        except Exception:
+            key = None
+        bucket = self._queues.get(key)
+        if bucket is None:
+            bucket = self._queues[key] = deque()
+        bucket.append(item)
+        self._size += 1
+        update_id = getattr(item, 'update_id', None)
+        if isinstance(update_id, int):
+            heapq.heappush(self._unprocessed, update_id)
+            if self._max_received is None or update_id > self._max_received:
+                self._max_received = update_id
+
+    def _get(self):
+        key, bucket = next(iter(self._queues.items()))
+        item = bucket.popleft()
+        # Ключ уходит в конец круга; пустые очереди удаляются
+        if bucket:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        self._size -= 1
+        return item
+
+    def mark_processed(self, update_id: int):
+        with self.mutex:
+            self._processed.add(update_id)
+            while self._unprocessed and self._unprocessed[0] in self._processed:
+                self._processed.discard(heapq.heappop(self._unprocessed))
+
+    def watermark(self) -> Optional[int]:
+        """Наибольший update_id, до которого включительно обработаны все полученные обновления."""
+        with self.mutex:
+            if self._unprocessed:
+                return self._unprocessed[0] - 1
+            return self._max_received
+
+    def processed_above_watermark(self) -> Set[int]:
+        """update_id, обработанные раньше обновлений с меньшими номерами."""
+        with self.mutex:
+            return set(self._processed)
+
+    def backlog(self) -> Dict[Hashable, int]:
+        with self.mutex:
+            return {key: len(bucket) for key, bucket in self._queues.items()}
@@ -0,0 +1,117 @@
+from datetime import date
+
+from analytics import ReportStore
+
+TODAY = date(2024, 3, 14)
+
+
+class FakeCursor:
+    def __init__(self, rows, during_select=None):
+        self.rows = rows
+        self.during_select = during_select
+        self.params = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.params = params
+        # Изменения, пришедшие от других потоков, пока выполняется SELECT
+        if self.during_select:
+            self.during_select()
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows, during_select=None):
+        self.cursor_ = FakeCursor(rows, during_select)
+
+    def cursor(self):
+        return self.cursor_
+
+
+ROWS = [
+    (1, 10, 'Фугование', date(2024, 3, 14), 5),
+    (2, 10, 'Фугование', date(2024, 3, 10), 3),
+    (3, 20, 'Распил доски', date(2024, 3, 5), 7),
+    (4, 10, 'Фугование', date(2024, 3, 1), 2),
+]
+
+
+def loaded_store(rows=ROWS) -> ReportStore:
+    store = ReportStore(['Распил доски', 'Фугование'])
+    store.load(FakeConnection(rows), tenant_id=1)
+    return store
+
+
+def test_load_reads_rows_for_tenant():
+    connection = FakeConnection(ROWS)
+    store = ReportStore(['Фугование'])
+    store.load(connection, tenant_id=3)
+
+    assert store.loaded
+    assert len(store) == 4
+    assert connection.cursor_.params == (3,)
+    assert store.totals(date(2024, 3, 1), date(2024, 3, 15)) == {
+        (10, 'Фугование'): 10,
+        (20, 'Распил доски'): 7,
+    }
+
+
+def test_append_before_load_is_ignored_and_after_load_is_counted():
+    store = ReportStore(['Фугование'])
+    store.append(99, 10, 'Фугование', TODAY, 100)
+    assert len(store) == 0
+
+    store.load(FakeConnection(ROWS))
+    store.append(5, 30, 'Новый вид', TODAY, 4)
+    store.append(1, 10, 'Фугование', TODAY, 5)
+
+    assert len(store) == 5
+    assert store.totals(TODAY, date(2024, 3, 15)) == {(10, 'Фугование'): 5, (30, 'Новый вид'): 4}
+
+
+def test_changes_during_load_are_applied_after_snapshot():
+    store = ReportStore(['Фугование'])
+
+    def concurrent_changes():
+        store.append(5, 10, 'Фугование', TODAY, 6)
+        store.append(1, 10, 'Фугование', TODAY, 5)
+        store.update_amount(2, 30)
+        store.remove(4)
+
+    store.load(FakeConnection(ROWS, concurrent_changes))
+
+    assert sorted(int(r) for r in store.report_id[:len(store)]) == [1, 2, 3, 5]
+    assert store.totals(date(2024, 3, 1), date(2024, 3, 15))[(10, 'Фугование')] == 5 + 30 + 6
+
+
+def test_remove_and_update_amount():
+    store = loaded_store()
+    version = store.version
+
+    store.remove(1)
+    store.remove(1)
+    store.update_amount(3, 1)
+
+    assert len(store) == 3
+    assert store.version == version + 2
+    assert store.totals(date(2024, 3, 1), date(2024, 3, 15)) == {
+        (10, 'Фугование'): 5,
+        (20, 'Распил доски'): 1,
+    }
+
+
+def test_compare_periods():
+    store = loaded_store()
+
+    assert store.compare_periods(TODAY, 7) == {
+        (10, 'Фугование'): (8, 2),
+        (20, 'Распил доски'): (0, 7),
+    }
+    assert store.compare_periods(TODAY, 7, user_id=20) == {(20, 'Распил доски'): (0, 7)}
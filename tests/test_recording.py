@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+from telegram import Bot, CallbackQuery, Chat, Message, MessageEntity, Update, User
+
+from callbacks import encode_callback
+from recording import UpdateAnonymizer
+
+USER = User(id=424242, first_name='Иван', last_name='Петров', username='ivan', is_bot=False)
+CHAT = Chat(id=424242, type='private', first_name='Иван', username='ivan')
+DATE = datetime(2024, 3, 1, 12, 0)
+
+
+@pytest.fixture
+def bot():
+    return Bot('123456:TESTtokenTESTtokenTESTtokenTESTtok')
+
+
+@pytest.fixture
+def anonymizer():
+    return UpdateAnonymizer('test-salt')
+
+
+def round_trip(update: Update, anonymizer: UpdateAnonymizer, bot: Bot) -> Update:
+    return Update.de_json(anonymizer.anonymize(update.to_dict()), bot)
+
+
+def test_command_keeps_zero_offset_entity(anonymizer, bot):
+    message = Message(
+        message_id=1, date=DATE, chat=CHAT, from_user=USER, text='/start',
+        entities=[MessageEntity(type=MessageEntity.BOT_COMMAND, offset=0, length=6)]
+    )
+    restored = round_trip(Update(1, message=message), anonymizer, bot)
+
+    assert restored.message.text == '/start'
+    assert restored.message.entities[0].offset == 0
+    assert restored.message.entities[0].length == 6
+    assert restored.message.from_user.id == anonymizer.pseudonym(USER.id)
+    assert restored.message.from_user.username is None
+
+
+def test_callback_query_keeps_data(anonymizer, bot):
+    message = Message(message_id=7, date=DATE, chat=CHAT, text="Главное меню")
+    query = CallbackQuery(
+        id='99', from_user=USER, chat_instance='instance', message=message,
+        data=encode_callback('rw', 0)
+    )
+    restored = round_trip(Update(2, callback_query=query), anonymizer, bot)
+
+    assert restored.callback_query.data == '1:rw:0'
+    assert restored.callback_query.from_user.id == anonymizer.pseudonym(USER.id)
+    assert restored.callback_query.message.chat.id == anonymizer.pseudonym(CHAT.id)
+    assert restored.callback_query.from_user.is_bot is False
+
+
+def test_text_message_keeps_text(anonymizer, bot):
+    message = Message(message_id=3, date=DATE, chat=CHAT, from_user=USER, text='0')
+    restored = round_trip(Update(3, message=message), anonymizer, bot)
+
+    assert restored.update_id == 3
+    assert restored.message.text == '0'
+    assert restored.message.chat.id == anonymizer.pseudonym(CHAT.id)
+    assert restored.message.from_user.last_name is None